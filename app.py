@@ -1,12 +1,35 @@
+import bisect
+import functools
+import gzip
+import hashlib
+import hmac
+import html
 import json
+import math
 import os
+import posixpath
+import queue
+import random
+import re
+import secrets
 import sqlite3
+import tempfile
+import threading
 import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 import midtransclient
+import requests
+from midtransclient.error_midtrans import MidtransAPIError
+from requests.adapters import HTTPAdapter
 
-from flask import Flask, render_template, request, redirect, url_for, session, g, send_from_directory, flash, jsonify
-from werkzeug.utils import secure_filename
+from flask import Flask, Request, render_template, request, redirect, url_for, session, g, send_file, send_from_directory, flash, jsonify, stream_with_context
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
 
 
 app = Flask(__name__)
@@ -17,12 +40,33 @@ load_dotenv()
 app.secret_key = "dev"
 app.config["DATABASE"] = os.path.join(app.root_path, "sukaikan.db")
 app.config["UPLOAD_FOLDER"] = os.path.join(app.root_path, "uploads")
+app.config["IMAGE_CACHE_FOLDER"] = os.path.join(app.config["UPLOAD_FOLDER"], "variants")
+app.config["ASSET_BUILD_FOLDER"] = os.path.join(app.root_path, ".assets")
+# Hard cap for any request body; routes with uploads have tighter limits below
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+app.config["PROOF_MAX_DIMENSION"] = 1600  # payment proofs are downscaled in the background
+# In-process job scheduler (order expiry, batch closure). Set to 0 when the
+# jobs run in a sidecar with `flask run-jobs` instead.
+app.config["SCHEDULER_ENABLED"] = os.environ.get("SUKAIKAN_SCHEDULER", "1") == "1"
+# Sessions (and carts) live server-side, the cookie only holds an opaque id.
+# "sqlite" is shared by all processes, "memory" is per process, "cookie" is
+# Flask's signed cookie session.
+app.config["SESSION_BACKEND"] = os.environ.get("SUKAIKAN_SESSION_BACKEND", "sqlite")
+app.config["SESSION_LIFETIME"] = timedelta(days=30)
+app.config["CART_ABANDON_AFTER"] = timedelta(days=3)
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+os.makedirs(app.config["IMAGE_CACHE_FOLDER"], exist_ok=True)
+
+# SQLite tuning: pooled connections in WAL mode with tuned pragmas, so checkout
+# writes to orders don't block readers. Switch on with SUKAIKAN_DB_TUNING=1.
+app.config["DB_TUNING"] = os.environ.get("SUKAIKAN_DB_TUNING", "0") == "1"
+app.config["DB_POOL_SIZE"] = int(os.environ.get("SUKAIKAN_DB_POOL_SIZE", "8"))
+app.config["DB_BUSY_TIMEOUT"] = 5.0  # seconds
 
 # Midtrans Configuration
 # Replacing with actual sandbox keys is recommended, but for demo we use placeholders
-MIDTRANS_SERVER_KEY = "SB-Mid-server-YOUR_SERVER_KEY_HERE"
-MIDTRANS_CLIENT_KEY = "SB-Mid-client-YOUR_CLIENT_KEY_HERE"
+MIDTRANS_SERVER_KEY = os.environ.get("MIDTRANS_SERVER_KEY", "SB-Mid-server-YOUR_SERVER_KEY_HERE")
+MIDTRANS_CLIENT_KEY = os.environ.get("MIDTRANS_CLIENT_KEY", "SB-Mid-client-YOUR_CLIENT_KEY_HERE")
 
 snap = midtransclient.Snap(
     is_production=False,
@@ -30,6 +74,36 @@ snap = midtransclient.Snap(
     client_key=MIDTRANS_CLIENT_KEY
 )
 
+# Gateway client settings. MIDTRANS_SNAP_URL and MIDTRANS_CORE_URL point Snap
+# and the transaction status API at another base URL (e.g. a local stub
+# gateway). With PAYMENT_ASYNC the checkout redirects right away and the token
+# is created in a background pool.
+app.config["MIDTRANS_SNAP_URL"] = os.environ.get("MIDTRANS_SNAP_URL")
+app.config["MIDTRANS_CORE_URL"] = os.environ.get("MIDTRANS_CORE_URL")
+app.config["PAYMENT_CONNECT_TIMEOUT"] = 3.05
+app.config["PAYMENT_READ_TIMEOUT"] = 10
+app.config["PAYMENT_MAX_RETRIES"] = 2
+app.config["PAYMENT_CALL_BUDGET"] = 8  # seconds for a call including its retries
+app.config["PAYMENT_ASYNC"] = os.environ.get("SUKAIKAN_PAYMENT_ASYNC", "0") == "1"
+# Payment reconciliation: status API calls in flight at once, and how long
+# after its deadline a cancelled order is still checked for a late payment
+app.config["PAYMENT_RECONCILE_WORKERS"] = 4
+app.config["PAYMENT_RECONCILE_LOOKBACK"] = timedelta(hours=1)
+app.config["PAYMENT_RECONCILE_BUDGET"] = 60  # seconds per pass, the rest waits for the next one
+
+
+# Pillow is optional: without it product photos are served as uploaded
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# brotli is optional: without it only gzip variants of static assets are built
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 # === Gemini AI Configuration ===
 import google.generativeai as genai
@@ -55,8 +129,11 @@ Jika ada yang bertanya di luar topik ikan, makanan, atau SUKAIKAN, tolak dengan
 
 @app.context_processor
 def inject_cart_count():
-    cart = session.get("cart", {})
-    count = sum(cart.values())
+    if g.get("defer_cart_count"):
+        # Shared cached page, the badge is filled in by cart_count_fragment
+        return dict(cart_count=0, defer_cart_count=True)
+    items, _ = get_priced_cart()
+    count = sum(item["qty"] for item in items)
     return dict(cart_count=count)
 
 
@@ -130,20 +207,72 @@ INITIAL_BATCH = {
 }
 
 
+DB_TUNING_PRAGMAS = (
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",  # safe with WAL, fsync only at checkpoints
+    "pragma cache_size = -16000",  # ~16 MB page cache per connection
+    "pragma mmap_size = 134217728",  # 128 MB memory-mapped reads
+    "pragma temp_store = memory",
+)
+
+# Idle tuned connections as (database path, connection), most recent on top
+_db_pool = queue.LifoQueue()
+
+
+def connect_db(tuned=False):
+    db = sqlite3.connect(
+        app.config["DATABASE"],
+        timeout=app.config["DB_BUSY_TIMEOUT"],
+        check_same_thread=not tuned,  # pooled connections move between threads
+    )
+    db.row_factory = sqlite3.Row
+    if tuned:
+        for pragma in DB_TUNING_PRAGMAS:
+            db.execute(pragma)
+    return db
+
+
+def _checkout_pooled_db():
+    path = app.config["DATABASE"]
+    while True:
+        try:
+            pooled_path, db = _db_pool.get_nowait()
+        except queue.Empty:
+            return connect_db(tuned=True)
+        if pooled_path == path:
+            return db
+        db.close()  # DATABASE was reconfigured, drop stale connections
+
+
+def _return_pooled_db(db):
+    if db.in_transaction:
+        db.rollback()
+    if _db_pool.qsize() >= app.config["DB_POOL_SIZE"]:
+        db.close()
+    else:
+        _db_pool.put((app.config["DATABASE"], db))
+
+
 def get_db():
     db = getattr(g, "_db", None)
     if db is None:
-        db = sqlite3.connect(app.config["DATABASE"])
-        db.row_factory = sqlite3.Row
+        if app.config["DB_TUNING"]:
+            db = _checkout_pooled_db()
+            g._db_pooled = True
+        else:
+            db = connect_db()
         g._db = db
     return db
 
 
 @app.teardown_appcontext
 def close_db(exception):
-    db = getattr(g, "_db", None)
+    db = g.pop("_db", None)
     if db is not None:
-        db.close()
+        if g.pop("_db_pooled", False):
+            _return_pooled_db(db)
+        else:
+            db.close()
 
 
 def init_db():
@@ -185,11 +314,6 @@ def init_db():
         """
     )
     
-    # Migration: Check if image_path exists in products, if not add it
-    try:
-        db.execute("select image_path from products limit 1")
-    except sqlite3.OperationalError:
-        db.execute("alter table products add column image_path text")
 
     # Recommendations Table (New)
     db.execute(
@@ -218,21 +342,363 @@ def init_db():
         )
         """
     )
-    
-    # Migration: Check if deadline exists in batches, if not add it
-    try:
-        db.execute("select deadline from batches limit 1")
-    except sqlite3.OperationalError:
-        db.execute("alter table batches add column deadline text")
-    
-    # Migration: Check if payment_deadline exists in orders, if not add it
-    try:
-        db.execute("select payment_deadline from orders limit 1")
-    except sqlite3.OperationalError:
-        db.execute("alter table orders add column payment_deadline text")
-        
+
     db.commit()
+    run_migrations(db)
     seed_data(db)
+    reset_catalog_snapshot()
+    reset_batch_state()
+
+
+# --- Schema Migrations ---
+# Each migration runs once, in order, inside its own transaction. The number
+# of applied migrations is tracked in PRAGMA user_version.
+
+def _add_column_if_missing(db, table, column, decl):
+    columns = [row["name"] for row in db.execute(f"pragma table_info({table})")]
+    if column not in columns:
+        db.execute(f"alter table {table} add column {column} {decl}")
+
+
+def migration_baseline_columns(db):
+    # Columns that older databases were created without
+    _add_column_if_missing(db, "products", "image_path", "text")
+    _add_column_if_missing(db, "batches", "deadline", "text")
+    _add_column_if_missing(db, "orders", "payment_deadline", "text")
+
+
+def migration_add_indexes(db):
+    db.execute("create index if not exists idx_orders_hp_created_at on orders(hp, created_at)")
+    db.execute("create index if not exists idx_orders_created_at on orders(created_at)")
+    db.execute("create index if not exists idx_orders_status_deadline on orders(status, payment_deadline)")
+    db.execute("create index if not exists idx_products_active_kategori on products(is_active, kategori)")
+    db.execute("create index if not exists idx_recommendations_product_id on recommendations(product_id)")
+
+
+def migration_order_items(db):
+    # Normalized order lines, backfilled from the legacy orders.items_json blob
+    db.execute(
+        """
+        create table if not exists order_items (
+            id integer primary key autoincrement,
+            order_id integer not null,
+            product_id text,
+            nama text,
+            harga_per_kg integer,
+            qty integer,
+            subtotal integer,
+            foreign key(order_id) references orders(id)
+        )
+        """
+    )
+    db.execute("create index if not exists idx_order_items_order_id on order_items(order_id)")
+    db.execute("create index if not exists idx_order_items_product_id on order_items(product_id)")
+
+    rows = db.execute(
+        "select id, items_json from orders where id not in (select order_id from order_items)"
+    ).fetchall()
+    for row in rows:
+        insert_order_items(db, row["id"], json.loads(row["items_json"] or "[]"))
+
+
+def migration_sales_stats(db):
+    db.execute(
+        """
+        create table if not exists sales_stats (
+            tanggal text,
+            tanggal_pengiriman text,
+            product_id text,
+            jumlah_pesanan integer default 0,
+            total_kg integer default 0,
+            total_penjualan integer default 0,
+            primary key (tanggal, tanggal_pengiriman, product_id)
+        )
+        """
+    )
+    rebuild_sales_stats(db)
+
+
+# Keeps one products_fts row per product (sharing its rowid) with the product
+# text and the names of its recipes
+_PRODUCTS_FTS_REFRESH = """
+    delete from products_fts where rowid in (select rowid from products where id = {pid});
+    insert into products_fts (rowid, product_id, nama, kategori, ukuran, tekstur, resep)
+    select p.rowid, p.id, p.nama, p.kategori, p.ukuran, p.tekstur,
+           (select group_concat(r.nama, ' ') from recommendations r where r.product_id = p.id)
+    from products p where p.id = {pid};
+"""
+
+
+def migration_products_fts(db):
+    try:
+        db.execute(
+            """
+            create virtual table if not exists products_fts using fts5(
+                product_id unindexed, nama, kategori, ukuran, tekstur, resep,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+            """
+        )
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5, search falls back to substring matching
+        print(f"FTS5 not available, skipping products_fts: {e}")
+        return
+
+    db.execute("drop trigger if exists products_fts_ai")
+    db.execute("drop trigger if exists products_fts_au")
+    db.execute("drop trigger if exists products_fts_ad")
+    db.execute("drop trigger if exists recommendations_fts_ai")
+    db.execute("drop trigger if exists recommendations_fts_au")
+    db.execute("drop trigger if exists recommendations_fts_ad")
+    db.execute(f"create trigger products_fts_ai after insert on products begin {_PRODUCTS_FTS_REFRESH.format(pid='new.id')} end")
+    db.execute(
+        f"""
+        create trigger products_fts_au after update on products begin
+            delete from products_fts where rowid = old.rowid;
+            {_PRODUCTS_FTS_REFRESH.format(pid='new.id')}
+        end
+        """
+    )
+    db.execute("create trigger products_fts_ad after delete on products begin delete from products_fts where rowid = old.rowid; end")
+    db.execute(f"create trigger recommendations_fts_ai after insert on recommendations begin {_PRODUCTS_FTS_REFRESH.format(pid='new.product_id')} end")
+    db.execute(
+        f"""
+        create trigger recommendations_fts_au after update on recommendations begin
+            {_PRODUCTS_FTS_REFRESH.format(pid='old.product_id')}
+            {_PRODUCTS_FTS_REFRESH.format(pid='new.product_id')}
+        end
+        """
+    )
+    db.execute(f"create trigger recommendations_fts_ad after delete on recommendations begin {_PRODUCTS_FTS_REFRESH.format(pid='old.product_id')} end")
+
+    db.execute("delete from products_fts")
+    db.execute(
+        """
+        insert into products_fts (rowid, product_id, nama, kategori, ukuran, tekstur, resep)
+        select p.rowid, p.id, p.nama, p.kategori, p.ukuran, p.tekstur,
+               (select group_concat(r.nama, ' ') from recommendations r where r.product_id = p.id)
+        from products p
+        """
+    )
+
+
+def migration_snap_tokens(db):
+    # Snap tokens per order so "bayar ulang" can reuse them until the deadline
+    db.execute(
+        """
+        create table if not exists snap_tokens (
+            order_id integer primary key,
+            token text not null,
+            transaction_id text not null,
+            expires_at text not null,
+            created_at text not null
+        )
+        """
+    )
+    db.execute("create index if not exists idx_snap_tokens_expires on snap_tokens(expires_at)")
+
+
+def migration_batch_capacity(db):
+    # Kg quota per product per batch, reserved atomically at checkout. Products
+    # without a row have no limit.
+    _add_column_if_missing(db, "orders", "batch_id", "integer")
+    _add_column_if_missing(db, "orders", "idempotency_key", "text")
+    db.execute("create unique index if not exists idx_orders_idempotency_key on orders(idempotency_key)")
+    db.execute(
+        """
+        create table if not exists batch_capacity (
+            batch_id integer not null,
+            product_id text not null,
+            capacity_kg integer not null,
+            reserved_kg integer not null default 0,
+            primary key (batch_id, product_id)
+        )
+        """
+    )
+
+
+def migration_ai_answers(db):
+    # Persisted AI chat answers by normalized question (see AIChatService)
+    db.execute(
+        """
+        create table if not exists ai_answers (
+            question_key text primary key,
+            answer text not null,
+            created_at real not null
+        )
+        """
+    )
+
+
+def migration_rate_limits(db):
+    # Token buckets for the sqlite rate limit backend
+    db.execute(
+        """
+        create table if not exists rate_limits (
+            key text primary key,
+            tokens real not null,
+            updated real not null
+        )
+        """
+    )
+
+
+def migration_sessions(db):
+    # Server-side sessions and carts (ServerSideSessionInterface)
+    db.execute(
+        """
+        create table if not exists sessions (
+            sid text primary key,
+            data text not null,
+            created_at text not null,
+            updated_at text not null,
+            expires_at text not null
+        )
+        """
+    )
+    db.execute("create index if not exists idx_sessions_expires on sessions(expires_at)")
+    db.execute(
+        """
+        create table if not exists carts (
+            sid text not null,
+            product_id text not null,
+            qty integer not null,
+            updated_at text not null,
+            primary key (sid, product_id)
+        )
+        """
+    )
+    db.execute("create index if not exists idx_carts_updated on carts(updated_at)")
+    db.execute(
+        """
+        create table if not exists abandoned_carts (
+            id integer primary key autoincrement,
+            sid text not null,
+            product_id text not null,
+            qty integer not null,
+            updated_at text not null,
+            expired_at text not null
+        )
+        """
+    )
+
+
+def migration_batch_deadlines(db):
+    # Batches from before the deadline column only had a countdown string;
+    # give them a deadline once instead of on the read path
+    rows = db.execute("select id, countdown from batches where deadline is null and countdown is not null").fetchall()
+    for row in rows:
+        try:
+            deadline = countdown_to_deadline(row["countdown"])
+        except ValueError as e:
+            print(f"Error migrating countdown to deadline: {e}")
+            continue
+        db.execute("update batches set deadline = ? where id = ?", (deadline.isoformat(), row["id"]))
+
+
+def migration_order_status_version(db):
+    # Bumped on every status change, long-polling clients wait for a new one
+    _add_column_if_missing(db, "orders", "status_version", "integer not null default 0")
+
+
+def migration_catalog_version(db):
+    # Any write to products or recommendations bumps the catalog version in the
+    # same transaction, so every process sees its snapshot go stale
+    db.execute("create table if not exists cache_versions (name text primary key, version integer not null)")
+    db.execute("insert or ignore into cache_versions (name, version) values ('catalog', 0)")
+    for table in ("products", "recommendations"):
+        for event in ("insert", "update", "delete"):
+            db.execute(f"drop trigger if exists {table}_catalog_version_{event[0]}")
+            db.execute(
+                f"""
+                create trigger {table}_catalog_version_{event[0]} after {event} on {table} begin
+                    update cache_versions set version = version + 1 where name = 'catalog';
+                end
+                """
+            )
+
+
+def migration_snap_token_reconciled_at(db):
+    # reconcile_payments checks the least recently checked transactions first
+    _add_column_if_missing(db, "snap_tokens", "reconciled_at", "text")
+
+
+def migration_batch_version(db):
+    # Same as the catalog version, for the batch state every process keeps
+    db.execute("insert or ignore into cache_versions (name, version) values ('batch', 0)")
+    for event in ("insert", "update", "delete"):
+        db.execute(f"drop trigger if exists batches_batch_version_{event[0]}")
+        db.execute(
+            f"""
+            create trigger batches_batch_version_{event[0]} after {event} on batches begin
+                update cache_versions set version = version + 1 where name = 'batch';
+            end
+            """
+        )
+
+
+MIGRATIONS = [
+    migration_baseline_columns,
+    migration_add_indexes,
+    migration_order_items,
+    migration_sales_stats,
+    migration_products_fts,
+    migration_snap_tokens,
+    migration_batch_capacity,
+    migration_ai_answers,
+    migration_rate_limits,
+    migration_sessions,
+    migration_batch_deadlines,
+    migration_order_status_version,
+    migration_catalog_version,
+    migration_snap_token_reconciled_at,
+    migration_batch_version,
+]
+
+
+def run_migrations(db):
+    version = db.execute("pragma user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        db.execute("begin")
+        try:
+            migration(db)
+            db.execute(f"pragma user_version = {number}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return version, len(MIGRATIONS)
+
+
+# Hot queries checked by `flask migrate` to confirm they hit an index
+EXPLAINED_QUERIES = [
+    ("lacak_pesanan", "select * from orders where hp = ? order by created_at desc", ("08",)),
+    ("admin_dashboard", "select * from orders order by created_at desc limit 50", ()),
+    ("pesanan kedaluwarsa", "select id from orders where status = ? and payment_deadline < ?", ("Menunggu Pembayaran", "")),
+    ("produk per kategori", "select * from products where is_active = 1 and kategori = ?", ("ikan-laut",)),
+    ("rekomendasi", "select * from recommendations where product_id = ?", ("kembung-fillet",)),
+]
+
+
+def explain_query_plans(db):
+    report = []
+    for name, query, params in EXPLAINED_QUERIES:
+        plan = [row["detail"] for row in db.execute("explain query plan " + query, params)]
+        report.append((name, plan))
+    return report
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Create tables, run pending migrations and print query plans."""
+    init_db()
+    db = get_db()
+    print(f"Schema version: {db.execute('pragma user_version').fetchone()[0]}")
+    for name, plan in explain_query_plans(db):
+        print(f"\n{name}:")
+        for detail in plan:
+            print(f"  {detail}")
 
 
 @app.route("/admin/produk/tambah", methods=["GET", "POST"])
@@ -251,13 +717,16 @@ def admin_tambah_produk():
         image_path = ""
         file = request.files.get("image")
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            ext = os.path.splitext(filename)[1]
-            if not ext: ext = ".jpg"
             # use product_id as filename for uniqueness
-            new_filename = f"{product_id}_{int(time.time())}{ext}"
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], new_filename)
-            file.save(filepath)
+            try:
+                new_filename = save_upload(
+                    file, f"{product_id}_{int(time.time())}", PRODUCT_IMAGE_KINDS, UPLOAD_LIMITS["admin_tambah_produk"]
+                )
+            except UploadRejected as e:
+                flash(str(e), "error")
+                return redirect(url_for("admin_tambah_produk"))
+            generate_image_variants(new_filename)
+            register_asset("uploaded_file", new_filename)
             image_path = new_filename
 
         db = get_db()
@@ -266,6 +735,7 @@ def admin_tambah_produk():
             (product_id, nama, kategori, harga, ukuran, tekstur, "", image_path)
         )
         db.commit()
+        refresh_catalog_version()
         return redirect(url_for("admin_dashboard"))
     return render_template("product_form.html", action="Tambah")
 
@@ -284,12 +754,15 @@ def admin_edit_produk(product_id):
         # Handle Image Upload
         file = request.files.get("image")
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            ext = os.path.splitext(filename)[1]
-            if not ext: ext = ".jpg"
-            new_filename = f"{product_id}_{int(time.time())}{ext}"
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], new_filename)
-            file.save(filepath)
+            try:
+                new_filename = save_upload(
+                    file, f"{product_id}_{int(time.time())}", PRODUCT_IMAGE_KINDS, UPLOAD_LIMITS["admin_edit_produk"]
+                )
+            except UploadRejected as e:
+                flash(str(e), "error")
+                return redirect(url_for("admin_edit_produk", product_id=product_id))
+            generate_image_variants(new_filename)
+            register_asset("uploaded_file", new_filename)
             
             # Update with new image
             db.execute(
@@ -304,6 +777,7 @@ def admin_edit_produk(product_id):
             )
             
         db.commit()
+        refresh_catalog_version()
         return redirect(url_for("admin_dashboard"))
         
     product = db.execute("select * from products where id = ?", (product_id,)).fetchone()
@@ -331,118 +805,540 @@ def seed_data(db):
     batch_count = db.execute("select count(*) from batches").fetchone()[0]
     if batch_count == 0:
         db.execute(
-            "insert into batches (nama, tanggal_pengiriman, status, countdown, is_active) values (?, ?, ?, ?, 1)",
-            (INITIAL_BATCH["nama"], INITIAL_BATCH["tanggal_pengiriman"], INITIAL_BATCH["status"], INITIAL_BATCH["countdown"])
+            "insert into batches (nama, tanggal_pengiriman, status, countdown, deadline, is_active) values (?, ?, ?, ?, ?, 1)",
+            (
+                INITIAL_BATCH["nama"],
+                INITIAL_BATCH["tanggal_pengiriman"],
+                INITIAL_BATCH["status"],
+                INITIAL_BATCH["countdown"],
+                countdown_to_deadline(INITIAL_BATCH["countdown"]).isoformat(),
+            )
         )
         db.commit()
 
 
-def get_active_batch():
-    db = get_db()
-    batch = db.execute("select * from batches where is_active = 1 order by id desc limit 1").fetchone()
-    if batch:
-        b = dict(batch)
-        
-        # Auto-Migration: If deadline is missing but countdown exists, set deadline from now + duration
-        if not b.get("deadline") and b.get("countdown"):
-            try:
-                parts = b["countdown"].split(":")
-                if len(parts) == 4: # D:HH:MM:SS
-                    days = int(parts[0])
-                    hours = int(parts[1])
-                    minutes = int(parts[2])
-                    seconds = int(parts[3])
-                elif len(parts) == 3: # HH:MM:SS (old format, 0 days)
-                    days = 0
-                    hours = int(parts[0])
-                    minutes = int(parts[1])
-                    seconds = int(parts[2])
-                else:
-                     raise ValueError("Unknown format")
-                
-                deadline = datetime.now() + timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
-                deadline_str = deadline.isoformat()
-                
-                # Update DB
-                db.execute("update batches set deadline = ? where id = ?", (deadline_str, b["id"]))
-                db.commit()
-                b["deadline"] = deadline_str
-                
-            except Exception as e:
-                print(f"Error migrating countdown to deadline: {e}")
+# --- Active Batch State ---
+# The active batch is shown on most pages but only changes through
+# admin_update_batch, close_expired_batches or its deadline passing. It is
+# kept in process and rebuilt when the batch row in cache_versions moves
+# (triggers on batches bump it, whichever process wrote) or the deadline
+# passes; the rebuild at the deadline is where open turns into closed.
+_batch_lock = threading.Lock()
+_batch_state = None
 
-        # Calculate dynamic countdown based on deadline
-        if b.get("deadline"):
-            try:
-                deadline = datetime.fromisoformat(b["deadline"])
-                now = datetime.now()
-                remaining = deadline - now
-                total_seconds = int(remaining.total_seconds())
-                
-                if total_seconds > 0:
-                    days = total_seconds // 86400
-                    rem = total_seconds % 86400
-                    hours = rem // 3600
-                    rem = rem % 3600
-                    minutes = rem // 60
-                    seconds = rem % 60
-                    # Format for frontend JS: D:HH:MM:SS
-                    b["countdown"] = f"{days}:{hours:02d}:{minutes:02d}:{seconds:02d}"
-                else:
-                    b["countdown"] = "0:00:00:00"
-            except ValueError:
-                pass # fallback to static countdown if parsing fails
 
-        if not b.get("countdown"):
-            b["countdown"] = "0:00:00:00"
-        return b
-    return INITIAL_BATCH  # Fallback if DB issue
+def countdown_to_deadline(countdown, now=None):
+    # "D:HH:MM:SS" or "HH:MM:SS" from now, server local time
+    parts = [int(part) for part in countdown.split(":")]
+    if len(parts) == 3:
+        parts.insert(0, 0)
+    if len(parts) != 4:
+        raise ValueError(f"Unknown countdown format: {countdown}")
+    days, hours, minutes, seconds = parts
+    return (now or datetime.now()) + timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+
+def current_batch_version():
+    # Read once per request (or job), refresh_batch_version() forgets it
+    version = g.get("_batch_version")
+    if version is None:
+        row = get_db().execute("select version from cache_versions where name = 'batch'").fetchone()
+        version = g._batch_version = row["version"] if row else 0
+    return version
+
+
+def refresh_batch_version():
+    # Call after committing a batch write so the rest of the request sees it
+    g.pop("_batch_version", None)
+
+
+def reset_batch_state():
+    # For init_db: a different database file may be at a lower version
+    global _batch_state
+    with _batch_lock:
+        _batch_state = None
+    refresh_batch_version()
+
+
+def build_batch_state(db, generation):
+    row = db.execute("select * from batches where is_active = 1 order by id desc limit 1").fetchone()
+    b = dict(row) if row else dict(INITIAL_BATCH)  # Fallback if DB issue
+    now = time.time()
+
+    b["deadline_epoch"] = None
+    if b.get("deadline"):
+        try:
+            b["deadline_epoch"] = int(datetime.fromisoformat(b["deadline"]).timestamp())
+        except ValueError:
+            print(f"Invalid batch deadline: {b['deadline']}")
+
+    passed = b["deadline_epoch"] is not None and b["deadline_epoch"] <= now
+    if passed:
+        b["status"] = "Tutup"  # close_expired_batches persists this on its next run
+    b["is_open"] = b["status"] == "Buka"
+
+    refresh_at = b["deadline_epoch"] if b["deadline_epoch"] and not passed else math.inf
+    return {"generation": generation, "refresh_at": refresh_at, "batch": b}
+
+
+def get_active_batch():
+    # Shared dict, treat it as read-only. The countdown is computed by the
+    # browser from deadline_epoch.
+    global _batch_state
+    version = current_batch_version()
+    state = _batch_state
+    if state is not None and state["generation"] >= version and time.time() < state["refresh_at"]:
+        return state["batch"]
+    with _batch_lock:
+        state = _batch_state
+        if state is None or state["generation"] < version or time.time() >= state["refresh_at"]:
+            state = build_batch_state(get_db(), version)
+            _batch_state = state
+        return state["batch"]
+
+
+# --- Catalog Snapshot Cache ---
+# Products and recommendations only change through the admin product routes,
+# so storefront reads are served from an in-memory snapshot instead of SQLite.
+# Triggers bump the catalog row in cache_versions with every write; each
+# request reads that version once and rebuilds the snapshot when it moved, so
+# writes from other processes are picked up too. Snapshot dicts are shared,
+# treat them as read-only.
+_catalog_lock = threading.Lock()
+_catalog_snapshot = None
+
+
+def current_catalog_version():
+    # Read once per request (or job), refresh_catalog_version() forgets it
+    version = g.get("_catalog_version")
+    if version is None:
+        row = get_db().execute("select version from cache_versions where name = 'catalog'").fetchone()
+        version = g._catalog_version = row["version"] if row else 0
+    return version
+
+
+def refresh_catalog_version():
+    # Call after committing a product write so the rest of the request sees it
+    g.pop("_catalog_version", None)
+
+
+def reset_catalog_snapshot():
+    # For init_db: a different database file may be at a lower version
+    global _catalog_snapshot
+    with _catalog_lock:
+        _catalog_snapshot = None
+    refresh_catalog_version()
+
+
+def build_catalog_snapshot(db, generation):
+    products = {}
+    active = []
+    by_kategori = {}
+    for row in db.execute("select * from products order by rowid"):
+        p = dict(row)
+        products[p["id"]] = p
+        if p["is_active"] == 1:
+            active.append(p)
+            by_kategori.setdefault(p["kategori"], []).append(p)
+
+    recommendations = {}
+    for row in db.execute("select * from recommendations order by id"):
+        r = dict(row)
+        recommendations.setdefault(r["product_id"], []).append(r)
+
+    return {
+        "generation": generation,
+        "products": products,  # all products by id, including inactive ones
+        "active": active,
+        "by_kategori": by_kategori,
+        "musim": [p for p in active if p["label_musim"]],
+        "recommendations": recommendations,
+        "suggest": build_suggest_index(active, recommendations),
+        "answers": build_answer_index(active, recommendations),
+    }
+
+
+def normalize_suggest_text(text):
+    return " ".join(re.findall(r"\w+", (text or "").lower()))
+
+
+def build_suggest_index(active, recommendations):
+    # Sorted (key, word position, kind, label, product_id) entries, one per word
+    # of every product and recipe name, so a bisect finds names by any word
+    # prefix ("vana" -> "Udang Vaname").
+    entries = set()
+    for p in active:
+        names = [("produk", p["nama"])]
+        names += [("resep", r["nama"]) for r in recommendations.get(p["id"], [])]
+        for kind, label in names:
+            words = normalize_suggest_text(label).split(" ")
+            for position in range(len(words)):
+                key = " ".join(words[position:])
+                if key:
+                    entries.add((key, position, kind, label, p["id"]))
+    entries = sorted(entries)
+    return {"keys": [e[0] for e in entries], "entries": entries}
+
+
+def suggest_products(query, limit=8):
+    prefix = normalize_suggest_text(query)
+    if not prefix:
+        return []
+    index = get_catalog()["suggest"]
+    keys = index["keys"]
+    matches = []
+    i = bisect.bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix) and len(matches) < limit * 4:
+        matches.append(index["entries"][i])
+        i += 1
+
+    # Names starting with the query first, products before recipes
+    matches.sort(key=lambda e: (e[1] > 0, e[2] != "produk", e[3]))
+    suggestions = []
+    seen = set()
+    for key, position, kind, label, product_id in matches:
+        if label in seen:
+            continue
+        seen.add(label)
+        suggestions.append({"label": label, "type": kind, "product_id": product_id})
+        if len(suggestions) == limit:
+            break
+    return suggestions
+
+
+def get_catalog():
+    # A snapshot newer than this request's version is fine to serve as well
+    global _catalog_snapshot
+    version = current_catalog_version()
+    snapshot = _catalog_snapshot
+    if snapshot is not None and snapshot["generation"] >= version:
+        return snapshot
+    with _catalog_lock:
+        snapshot = _catalog_snapshot
+        if snapshot is None or snapshot["generation"] < version:
+            snapshot = build_catalog_snapshot(get_db(), version)
+            _catalog_snapshot = snapshot
+        return snapshot
+
+
+# bm25 column weights: product_id, nama, kategori, ukuran, tekstur, resep
+PRODUCT_SEARCH_RANK = "bm25(products_fts, 0.0, 10.0, 2.0, 1.0, 1.0, 4.0)"
+
+
+def build_fts_query(search_query):
+    # Every word must match, each as a prefix so search-as-you-type works
+    # ("uda" finds "Udang Vaname"). Words are quoted to neutralize FTS syntax.
+    words = re.findall(r"\w+", search_query.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_product_ids(search_query, category=None, limit=200):
+    # Active product ids ranked by relevance, or None if the FTS index is
+    # unavailable. Filters are applied before the limit, the index also holds
+    # inactive products. products_fts rowids are the products rowids.
+    fts_query = build_fts_query(search_query)
+    if not fts_query:
+        return []
+    category = category or None  # katalog passes "" for all categories
+    try:
+        rows = get_db().execute(
+            f"""
+            select p.id as product_id from products_fts
+            join products p on p.rowid = products_fts.rowid
+            where products_fts match ? and p.is_active = 1 and (? is null or p.kategori = ?)
+            order by {PRODUCT_SEARCH_RANK} limit ?
+            """,
+            (fts_query, category, category, limit),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    return [row["product_id"] for row in rows]
 
 
 def get_all_products(category=None, search_query=None):
-    db = get_db()
-    query = "select * from products where is_active = 1"
-    params = []
-    
+    catalog = get_catalog()
     if category:
-        query += " and kategori = ?"
-        params.append(category)
-    
+        products = catalog["by_kategori"].get(category, [])
+    else:
+        products = catalog["active"]
+
     if search_query:
-        query += " and nama like ?"
-        params.append(f"%{search_query}%")
-        
-    rows = db.execute(query, params).fetchall()
-    return [dict(row) for row in rows]
+        ranked_ids = search_product_ids(search_query, category)
+        if ranked_ids is None:
+            needle = search_query.lower()
+            products = [p for p in products if needle in (p["nama"] or "").lower()]
+        else:
+            candidates = {p["id"]: p for p in products}
+            products = [candidates[pid] for pid in ranked_ids if pid in candidates]
+
+    return list(products)
 
 
 def get_product_by_id(product_id):
-    db = get_db()
-    row = db.execute("select * from products where id = ?", (product_id,)).fetchone()
-    if row:
-        return dict(row)
-    return None
+    return get_catalog()["products"].get(product_id)
 
 
 def get_recommendations(product_id):
-    db = get_db()
-    rows = db.execute("select * from recommendations where product_id = ?", (product_id,)).fetchall()
-    return [dict(row) for row in rows]
+    return list(get_catalog()["recommendations"].get(product_id, []))
+
+
+# --- Server-side Sessions ---
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, updated_at=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.updated_at = updated_at
+        self.modified = False
+        self.accessed = False
+
+
+class SQLiteSessionStore:
+    def load(self, sid, now):
+        row = get_db().execute(
+            "select data, updated_at from sessions where sid = ? and expires_at > ?", (sid, now)
+        ).fetchone()
+        if row is None:
+            return None
+        return session_json_serializer.loads(row["data"]), row["updated_at"]
+
+    def save(self, sid, data, now, expires_at):
+        db = get_db()
+        db.execute(
+            """
+            insert into sessions (sid, data, created_at, updated_at, expires_at) values (?, ?, ?, ?, ?)
+            on conflict(sid) do update set data = excluded.data, updated_at = excluded.updated_at, expires_at = excluded.expires_at
+            """,
+            (sid, session_json_serializer.dumps(data), now, now, expires_at),
+        )
+        db.commit()
+
+    def get_cart(self, sid):
+        rows = get_db().execute("select product_id, qty from carts where sid = ? order by rowid", (sid,))
+        return {row["product_id"]: row["qty"] for row in rows}
+
+    def add_to_cart(self, sid, product_id, qty):
+        # One upsert, so adds from two tabs at once both land
+        db = get_db()
+        db.execute(
+            "insert into carts (sid, product_id, qty, updated_at) values (?, ?, ?, ?) on conflict(sid, product_id) do update set qty = qty + excluded.qty, updated_at = excluded.updated_at",
+            (sid, product_id, qty, datetime.utcnow().isoformat()),
+        )
+        db.commit()
+
+    def remove_from_cart(self, sid, product_id):
+        # Only this row, an add from another tab in the meantime stays
+        db = get_db()
+        db.execute("delete from carts where sid = ? and product_id = ?", (sid, product_id))
+        db.commit()
+
+    def set_cart(self, sid, cart):
+        db = get_db()
+        now = datetime.utcnow().isoformat()
+        db.execute("begin immediate")
+        try:
+            db.execute("delete from carts where sid = ?", (sid,))
+            db.executemany(
+                "insert into carts (sid, product_id, qty, updated_at) values (?, ?, ?, ?)",
+                [(sid, product_id, qty, now) for product_id, qty in cart.items()],
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    def expire(self, now, abandoned_before):
+        # Drops expired sessions and moves idle or orphaned carts to
+        # abandoned_carts. Returns the number of carts moved.
+        db = get_db()
+        db.execute("begin immediate")
+        try:
+            db.execute("delete from sessions where expires_at <= ?", (now,))
+            stale = "updated_at < ? or sid not in (select sid from sessions)"
+            db.execute(
+                f"insert into abandoned_carts (sid, product_id, qty, updated_at, expired_at) select sid, product_id, qty, updated_at, ? from carts where {stale}",
+                (now, abandoned_before),
+            )
+            moved = db.execute(f"select count(distinct sid) from carts where {stale}", (abandoned_before,)).fetchone()[0]
+            db.execute(f"delete from carts where {stale}", (abandoned_before,))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return moved
+
+
+class MemorySessionStore:
+    def __init__(self):
+        self._sessions = {}  # sid -> (data, updated_at, expires_at)
+        self._carts = {}  # sid -> ({product_id: qty}, updated_at)
+        self._lock = threading.Lock()
+
+    def load(self, sid, now):
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[2] <= now:
+            return None
+        return session_json_serializer.loads(entry[0]), entry[1]
+
+    def save(self, sid, data, now, expires_at):
+        with self._lock:
+            self._sessions[sid] = (session_json_serializer.dumps(data), now, expires_at)
+
+    def get_cart(self, sid):
+        with self._lock:
+            return dict(self._carts.get(sid, ({}, None))[0])
+
+    def add_to_cart(self, sid, product_id, qty):
+        with self._lock:
+            cart = self._carts.get(sid, ({}, None))[0]
+            cart[product_id] = cart.get(product_id, 0) + qty
+            self._carts[sid] = (cart, datetime.utcnow().isoformat())
+
+    def remove_from_cart(self, sid, product_id):
+        with self._lock:
+            cart = self._carts.get(sid, ({}, None))[0]
+            cart.pop(product_id, None)
+            self._carts[sid] = (cart, datetime.utcnow().isoformat())
+
+    def set_cart(self, sid, cart):
+        with self._lock:
+            self._carts[sid] = (dict(cart), datetime.utcnow().isoformat())
+
+    def expire(self, now, abandoned_before):
+        # Memory carts are simply dropped, only sqlite keeps abandoned_carts
+        with self._lock:
+            for sid in [sid for sid, entry in self._sessions.items() if entry[2] <= now]:
+                del self._sessions[sid]
+            stale = [
+                sid for sid, (cart, updated_at) in self._carts.items()
+                if updated_at < abandoned_before or sid not in self._sessions
+            ]
+            for sid in stale:
+                del self._carts[sid]
+        return len(stale)
+
+
+SESSION_STORES = {"sqlite": SQLiteSessionStore(), "memory": MemorySessionStore()}
+
+
+def get_session_store():
+    return SESSION_STORES.get(app.config["SESSION_BACKEND"])
+
+
+class ServerSideSessionInterface(SessionInterface):
+    # Rows are rewritten when the session changes, and otherwise at most
+    # once per refresh_after to slide the expiry.
+    refresh_after = timedelta(hours=1)
+    cookie_sessions = SecureCookieSessionInterface()
+
+    def open_session(self, app, request):
+        store = get_session_store()
+        if store is None:
+            return self.cookie_sessions.open_session(app, request)
+
+        value = request.cookies.get(self.get_cookie_name(app))
+        if value and "." in value:
+            # Signed cookie from before the switch, carry its contents over
+            legacy = self.cookie_sessions.open_session(app, request)
+            session = ServerSession(sid=secrets.token_urlsafe(32), new=True)
+            if legacy:
+                cart = legacy.pop("cart", None)
+                session.update(legacy)
+                if cart:
+                    store.set_cart(session.sid, cart)
+            return session
+        if value:
+            loaded = store.load(value, datetime.utcnow().isoformat())
+            if loaded is not None:
+                data, updated_at = loaded
+                return ServerSession(data, sid=value, updated_at=updated_at)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        if not isinstance(session, ServerSession):
+            return self.cookie_sessions.save_session(app, session, response)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if session.new and not session.modified:
+            return  # nothing worth a row or a cookie
+
+        now = datetime.utcnow()
+        stale = session.updated_at is None or session.updated_at < (now - self.refresh_after).isoformat()
+        if not (session.modified or stale):
+            return
+        lifetime = app.config["SESSION_LIFETIME"]
+        get_session_store().save(session.sid, dict(session), now.isoformat(), (now + lifetime).isoformat())
+        response.set_cookie(
+            self.get_cookie_name(app),
+            session.sid,
+            max_age=lifetime,
+            path=self.get_cookie_path(app),
+            domain=self.get_cookie_domain(app),
+            secure=self.get_cookie_secure(app),
+            httponly=self.get_cookie_httponly(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+app.session_interface = ServerSideSessionInterface()
 
 
 def get_cart():
-    return session.get("cart", {})
+    if not isinstance(session, ServerSession):
+        return dict(session.get("cart", {}))
+    cart = g.get("_cart")
+    if cart is None:
+        cart = {} if session.new and not session.modified else get_session_store().get_cart(session.sid)
+        g._cart = cart
+    return dict(cart)
 
 
 def save_cart(cart):
-    session["cart"] = cart
+    if not isinstance(session, ServerSession):
+        session["cart"] = cart
+        return
+    get_session_store().set_cart(session.sid, cart)
+    if session.new:
+        session.modified = True  # first cart write creates the session row and cookie
+    g._cart = dict(cart)
+
+
+def add_to_cart(product_id, qty):
+    if not isinstance(session, ServerSession):
+        cart = get_cart()
+        cart[product_id] = cart.get(product_id, 0) + qty
+        save_cart(cart)
+        return
+    store = get_session_store()
+    store.add_to_cart(session.sid, product_id, qty)
+    if session.new:
+        session.modified = True
+    g._cart = store.get_cart(session.sid)  # includes adds from other tabs
+
+
+def remove_from_cart(product_id):
+    if not isinstance(session, ServerSession):
+        cart = get_cart()
+        cart.pop(product_id, None)
+        save_cart(cart)
+        return
+    store = get_session_store()
+    store.remove_from_cart(session.sid, product_id)
+    g._cart = store.get_cart(session.sid)
 
 
 def build_order_items(cart):
+    # Prices the whole cart in one pass over the catalog snapshot
+    products = get_catalog()["products"]
     items = []
     total = 0
     for product_id, qty in cart.items():
-        product = get_product_by_id(product_id)
+        product = products.get(product_id)
         if not product:
             continue
         subtotal = product["harga_per_kg"] * qty
@@ -460,6 +1356,49 @@ def build_order_items(cart):
     return items, total
 
 
+def price_cart_for_order(db, cart):
+    # Checkout prices from SQLite inside its transaction, not from the snapshot,
+    # so a price change or deactivation in another process is never missed.
+    # Returns (items, total, product ids that can't be ordered).
+    product_ids = list(cart)
+    placeholders = ", ".join("?" * len(product_ids))
+    rows = db.execute(
+        f"select id, nama, harga_per_kg, is_active from products where id in ({placeholders})", product_ids
+    ).fetchall()
+    products = {row["id"]: row for row in rows if row["is_active"] == 1}
+    items = []
+    total = 0
+    for product_id, qty in cart.items():
+        product = products.get(product_id)
+        if product is None:
+            continue
+        subtotal = product["harga_per_kg"] * qty
+        total += subtotal
+        items.append(
+            {
+                "product_id": product_id,
+                "nama": product["nama"],
+                "harga_per_kg": product["harga_per_kg"],
+                "qty": qty,
+                "subtotal": subtotal,
+            }
+        )
+    return items, total, [product_id for product_id in product_ids if product_id not in products]
+
+
+def get_priced_cart():
+    # One priced cart per request, shared by the cart badge, the cart page,
+    # checkout and the AJAX add-to-cart response. Re-priced if the cart changed.
+    cart = get_cart()
+    key = tuple(cart.items())
+    cached = getattr(g, "_priced_cart", None)
+    if cached is None or cached[0] != key:
+        items, total = build_order_items(cart)
+        cached = (key, items, total)
+        g._priced_cart = cached
+    return cached[1], cached[2]
+
+
 def serialize_items_for_db(items):
     data = []
     for item in items:
@@ -475,15 +1414,333 @@ def serialize_items_for_db(items):
     return json.dumps(data)
 
 
-@app.route("/")
-def beranda():
-    batch = get_active_batch()
-    # Seasonal products query (has label_musim)
-    db = get_db()
-    rows = db.execute("select * from products where is_active = 1 and label_musim != ''").fetchall()
-    produk_musim = [dict(row) for row in rows]
-    
-    return render_template(
+def insert_order_items(db, order_id, items):
+    db.executemany(
+        "insert into order_items (order_id, product_id, nama, harga_per_kg, qty, subtotal) values (?, ?, ?, ?, ?, ?)",
+        [
+            (order_id, item.get("product_id"), item.get("nama"), item.get("harga_per_kg"), item.get("qty"), item.get("subtotal"))
+            for item in items
+        ],
+    )
+
+
+def get_order_items(db, orders):
+    # Returns {order_id: [items]} from order_items, falling back to the legacy
+    # items_json blob for orders that have no normalized rows (yet).
+    by_order = {}
+    ids = [o["id"] for o in orders]
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = db.execute(
+            f"select * from order_items where order_id in ({placeholders}) order by id", chunk
+        ).fetchall()
+        for row in rows:
+            by_order.setdefault(row["order_id"], []).append(dict(row))
+
+    for o in orders:
+        if o["id"] not in by_order:
+            by_order[o["id"]] = json.loads(o["items_json"] or "[]")
+    return by_order
+
+
+# --- Sales Rollups ---
+# sales_stats holds running totals per order day, per batch (tanggal_pengiriman)
+# and per product. Rows with product_id SALES_ALL_PRODUCTS hold order-level
+# totals, so order counts are not double counted across products. Every
+# writer that creates an order or moves it in or out of a counted status
+# applies the delta in the same transaction.
+ORDER_STATUS_PENDING = "Menunggu Pembayaran"
+ORDER_STATUS_PAID = "Sudah Dibayar"
+ORDER_STATUS_CANCELLED = "Dibatalkan"
+SALES_ALL_PRODUCTS = "*"
+SALES_EXCLUDED_STATUSES = (ORDER_STATUS_CANCELLED,)
+
+
+def record_sales(db, order_ids, sign=1):
+    if not order_ids:
+        return
+    placeholders = ", ".join("?" * len(order_ids))
+    upsert = """
+        on conflict(tanggal, tanggal_pengiriman, product_id) do update set
+            jumlah_pesanan = jumlah_pesanan + excluded.jumlah_pesanan,
+            total_kg = total_kg + excluded.total_kg,
+            total_penjualan = total_penjualan + excluded.total_penjualan
+    """
+    for product_column in ("oi.product_id", "?"):
+        params = [sign, sign, sign]
+        if product_column == "?":
+            params.insert(0, SALES_ALL_PRODUCTS)
+        db.execute(
+            f"""
+            insert into sales_stats (tanggal, tanggal_pengiriman, product_id, jumlah_pesanan, total_kg, total_penjualan)
+            select substr(o.created_at, 1, 10), o.tanggal_pengiriman, {product_column},
+                   ? * count(distinct o.id), ? * sum(oi.qty), ? * sum(oi.subtotal)
+            from orders o join order_items oi on oi.order_id = o.id
+            where o.id in ({placeholders})
+            group by 1, 2, 3
+            {upsert}
+            """,
+            params + list(order_ids),
+        )
+
+
+def rebuild_sales_stats(db):
+    # Recomputes the rollups from orders and order_items. Caller commits.
+    db.execute("delete from sales_stats")
+    excluded = ", ".join("?" * len(SALES_EXCLUDED_STATUSES))
+    rows = db.execute(
+        f"select id from orders where status not in ({excluded})", SALES_EXCLUDED_STATUSES
+    ).fetchall()
+    ids = [row["id"] for row in rows]
+    for start in range(0, len(ids), 500):
+        record_sales(db, ids[start:start + 500])
+
+
+def get_sales_summary(db):
+    totals = db.execute(
+        "select coalesce(sum(total_penjualan), 0), coalesce(sum(total_kg), 0) from sales_stats where product_id = ?",
+        (SALES_ALL_PRODUCTS,),
+    ).fetchone()
+    per_product = [dict(row) for row in db.execute(
+        """
+        select s.product_id, coalesce(p.nama, s.product_id) as nama,
+               sum(s.total_kg) as total_kg, sum(s.total_penjualan) as total_penjualan
+        from sales_stats s left join products p on p.id = s.product_id
+        where s.product_id != ?
+        group by s.product_id
+        having sum(s.jumlah_pesanan) > 0
+        order by total_penjualan desc
+        """,
+        (SALES_ALL_PRODUCTS,),
+    )]
+    per_batch = [dict(row) for row in db.execute(
+        """
+        select tanggal_pengiriman, sum(jumlah_pesanan) as jumlah_pesanan,
+               sum(total_kg) as total_kg, sum(total_penjualan) as total_penjualan
+        from sales_stats
+        where product_id = ?
+        group by tanggal_pengiriman
+        having sum(jumlah_pesanan) > 0
+        order by max(tanggal) desc
+        """,
+        (SALES_ALL_PRODUCTS,),
+    )]
+    return {
+        "total_penjualan": totals[0],
+        "total_kg": totals[1],
+        "per_product": per_product,
+        "per_batch": per_batch,
+    }
+
+
+def update_order_status(db, order_id, status):
+    # Changes an order's status and keeps sales_stats in step. Caller commits.
+    if not db.in_transaction:
+        db.execute("begin immediate")
+    # Raises CapacityConflict, changing nothing, when a cancelled order's kg
+    # no longer fit its batch.
+    row = db.execute("select status from orders where id = ?", (order_id,)).fetchone()
+    if row is None or row["status"] == status:
+        return False
+    was_counted = row["status"] not in SALES_EXCLUDED_STATUSES
+    is_counted = status not in SALES_EXCLUDED_STATUSES
+    if is_counted and not was_counted:
+        reserve_order_capacity(db, order_id)
+    db.execute("update orders set status = ?, status_version = status_version + 1 where id = ?", (status, order_id))
+    notify_order_status_later([order_id])
+    if was_counted != is_counted:
+        record_sales(db, [order_id], 1 if is_counted else -1)
+        if not is_counted:
+            release_batch_capacity(db, [order_id])
+    return True
+
+
+def reserve_batch_capacity(db, batch_id, items):
+    # Takes each item's kg out of the batch quota. Returns the items that did
+    # not fit as (item, remaining_kg); the caller then rolls back.
+    shortages = []
+    for item in items:
+        cursor = db.execute(
+            "update batch_capacity set reserved_kg = reserved_kg + ? where batch_id = ? and product_id = ? and reserved_kg + ? <= capacity_kg",
+            (item["qty"], batch_id, item["product_id"], item["qty"]),
+        )
+        if cursor.rowcount:
+            continue
+        row = db.execute(
+            "select capacity_kg - reserved_kg as sisa from batch_capacity where batch_id = ? and product_id = ?",
+            (batch_id, item["product_id"]),
+        ).fetchone()
+        if row is not None:
+            shortages.append((item, max(row["sisa"], 0)))
+    return shortages
+
+
+class CapacityConflict(Exception):
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(", ".join(f"{item['nama']} tinggal {sisa}kg" for item, sisa in shortages))
+
+
+def reserve_order_capacity(db, order_id):
+    # Takes an existing order's kg out of its batch quota again, all or
+    # nothing, e.g. when a cancelled order is paid after all
+    order = db.execute("select batch_id from orders where id = ?", (order_id,)).fetchone()
+    items = db.execute(
+        "select product_id, nama, sum(qty) as qty from order_items where order_id = ? group by product_id", (order_id,)
+    ).fetchall()
+    db.execute("savepoint reserve_order")
+    shortages = reserve_batch_capacity(db, order["batch_id"], items)
+    if shortages:
+        db.execute("rollback to reserve_order")
+    db.execute("release reserve_order")
+    if shortages:
+        raise CapacityConflict(shortages)
+
+
+def release_batch_capacity(db, order_ids, sign=-1):
+    # Gives the orders' kg back to their batch quotas (sign=1 takes it again,
+    # unchecked; see reserve_order_capacity)
+    placeholders = ", ".join("?" * len(order_ids))
+    db.execute(
+        f"""
+        update batch_capacity set reserved_kg = reserved_kg + ? * (
+            select coalesce(sum(oi.qty), 0)
+            from orders o join order_items oi on oi.order_id = o.id
+            where o.id in ({placeholders})
+              and o.batch_id = batch_capacity.batch_id
+              and oi.product_id = batch_capacity.product_id
+        )
+        where batch_id in (select batch_id from orders where id in ({placeholders}))
+        """,
+        [sign] + list(order_ids) + list(order_ids),
+    )
+
+
+def get_batch_capacity(db, batch_id):
+    return {
+        row["product_id"]: dict(row)
+        for row in db.execute("select * from batch_capacity where batch_id = ?", (batch_id,))
+    }
+
+
+def is_payment_expired(order, now=None):
+    # The status is written by expire_overdue_orders. The string comparison
+    # only covers the few seconds until its next run.
+    if order["status"] == ORDER_STATUS_CANCELLED:
+        return True
+    now = now or datetime.utcnow().isoformat()
+    return (
+        order["status"] == ORDER_STATUS_PENDING
+        and bool(order.get("payment_deadline"))
+        and order["payment_deadline"] < now
+    )
+
+
+def cancel_orders(db, order_ids):
+    # Bulk-cancels pending orders, takes them out of sales_stats and releases
+    # their batch reservations. Caller holds the write transaction and commits.
+    for start in range(0, len(order_ids), 500):
+        chunk = order_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        db.execute(
+            f"update orders set status = ?, status_version = status_version + 1 where id in ({placeholders})",
+            [ORDER_STATUS_CANCELLED] + chunk,
+        )
+        notify_order_status_later(chunk)
+        record_sales(db, chunk, -1)
+        release_batch_capacity(db, chunk)
+
+
+@app.cli.command("rebuild-sales-stats")
+def rebuild_sales_stats_command():
+    """Recompute sales_stats from scratch and report any drift."""
+    db = get_db()
+    before = get_sales_summary(db)
+    db.execute("begin immediate")
+    rebuild_sales_stats(db)
+    db.commit()
+    after = get_sales_summary(db)
+    for key in ("total_penjualan", "total_kg"):
+        status = "OK" if before[key] == after[key] else f"DRIFT (was {before[key]})"
+        print(f"{key}: {after[key]} {status}")
+    if before["per_product"] != after["per_product"] or before["per_batch"] != after["per_batch"]:
+        print("Per-product/per-batch rollups differed and were rebuilt.")
+
+
+# --- Page Cache ---
+# Anonymous storefront pages render the same HTML for every visitor, so the
+# rendered body is cached per route, query args and catalog generation (plus
+# whatever the view adds through `vary`). The cart badge is left out of the
+# cached HTML and fetched from cart_count_fragment. Responses carry a strong
+# ETag derived from the cache key and answer 304 when it matches.
+PAGE_CACHE_SIZE = 256
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+_boot_id = uuid.uuid4().hex[:8]  # other processes/deploys never share ETags
+
+
+def cached_page(vary=None):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pages carrying flash messages are per-user, render them normally
+            if session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            key = (
+                request.path,
+                tuple(sorted(request.args.items(multi=True))),
+                get_catalog()["generation"],
+                vary() if vary else None,
+            )
+            etag = hashlib.sha1(f"{_boot_id}{key}".encode()).hexdigest()[:20]
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                with _page_cache_lock:
+                    body = _page_cache.get(key)
+                    if body is not None:
+                        _page_cache.move_to_end(key)
+                if body is None:
+                    g.defer_cart_count = True
+                    response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response  # redirects etc. are not cached
+                    body = response.get_data()
+                    with _page_cache_lock:
+                        _page_cache[key] = body
+                        while len(_page_cache) > PAGE_CACHE_SIZE:
+                            _page_cache.popitem(last=False)
+                response = app.make_response(body)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"  # always revalidate
+            return response
+        return wrapper
+    return decorator
+
+
+def batch_cache_key():
+    batch = get_active_batch()
+    return (batch.get("id"), batch["nama"], batch["status"], batch.get("deadline"), batch["tanggal_pengiriman"])
+
+
+@app.route("/keranjang/jumlah")
+def cart_count_fragment():
+    items, _ = get_priced_cart()
+    response = jsonify({"cart_count": sum(item["qty"] for item in items)})
+    response.headers["Cache-Control"] = "private, no-store"
+    return response
+
+
+@app.route("/")
+@cached_page(vary=batch_cache_key)
+def beranda():
+    batch = get_active_batch()
+    # Seasonal products (has label_musim)
+    produk_musim = list(get_catalog()["musim"])
+    
+    return render_template(
         "beranda.html",
         batch=batch,
         produk_musim=produk_musim,
@@ -491,6 +1748,7 @@ def beranda():
 
 
 @app.route("/katalog")
+@cached_page()
 def katalog():
     kategori = request.args.get("kategori", "")
     q = request.args.get("q", "").strip()
@@ -505,7 +1763,16 @@ def katalog():
     )
 
 
+@app.route("/api/produk/suggest")
+def api_suggest_produk():
+    suggestions = suggest_products(request.args.get("q", "")[:64])
+    for item in suggestions:
+        item["url"] = url_for("detail_produk", product_id=item["product_id"])
+    return jsonify({"suggestions": suggestions})
+
+
 @app.route("/produk/<product_id>")
+@cached_page()
 def detail_produk(product_id):
     product = get_product_by_id(product_id)
     if not product:
@@ -520,8 +1787,7 @@ def detail_produk(product_id):
 
 @app.route("/keranjang")
 def keranjang():
-    cart = get_cart()
-    items, total = build_order_items(cart)
+    items, total = get_priced_cart()
     return render_template(
         "keranjang.html",
         items=items,
@@ -546,13 +1812,12 @@ def tambah_ke_keranjang():
             return jsonify({"success": False, "message": "Produk tidak ditemukan."}), 404
         return redirect(url_for("katalog"))
         
-    cart = get_cart()
-    cart[product_id] = cart.get(product_id, 0) + qty
-    save_cart(cart)
+    add_to_cart(product_id, qty)
     
     if request.headers.get("X-Requested-With") == "XMLHttpRequest":
         # Calculate new total count
-        cart_count = sum(cart.values())
+        items, _ = get_priced_cart()
+        cart_count = sum(item["qty"] for item in items)
         return jsonify({
             "success": True, 
             "message": f"{qty}kg {product['nama']} ditambah ke keranjang.", 
@@ -566,11 +1831,8 @@ def tambah_ke_keranjang():
 @app.route("/keranjang/hapus", methods=["POST"])
 def hapus_dari_keranjang():
     product_id = request.form.get("product_id")
-    cart = get_cart()
-    
-    if product_id in cart:
-        del cart[product_id]
-        save_cart(cart)
+    if product_id in get_cart():
+        remove_from_cart(product_id)
         
     return redirect(url_for("keranjang"))
 
@@ -578,6 +1840,18 @@ def hapus_dari_keranjang():
 @app.route("/checkout", methods=["GET", "POST"])
 def checkout():
     cart = get_cart()
+    if not cart and request.method == "POST":
+        # The first submit already emptied the cart; a repeat still lands on its order
+        idempotency_key = request.form.get("idempotency_key", "").strip()[:64]
+        existing = None
+        if idempotency_key:
+            existing = get_db().execute(
+                "select id, hp from orders where idempotency_key = ?", (idempotency_key,)
+            ).fetchone()
+        if existing:
+            session["last_order_id"] = existing["id"]
+            session["last_hp"] = existing["hp"]
+            return redirect(url_for("berhasil_pesan"))
     if not cart:
         return redirect(url_for("katalog"))
         
@@ -597,62 +1871,81 @@ def checkout():
         kecamatan = "-" # Removed from form
         metode_bayar = request.form.get("metode_bayar", "").strip()
         
-        items, total = build_order_items(cart)
-        items_json = serialize_items_for_db(items)
         created_at = datetime.utcnow().isoformat()
-        status = "Menunggu Pembayaran"
+        status = ORDER_STATUS_PENDING
         
         completed_at = None
         payment_deadline = (datetime.utcnow() + timedelta(minutes=5)).isoformat()
         
-        db = get_db()
-        cursor = db.execute(
-            "insert into orders (nama, hp, alamat, kecamatan, metode_bayar, total, status, tanggal_pengiriman, items_json, created_at, payment_deadline) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                nama,
-                hp,
-                alamat,
-                kecamatan,
-                metode_bayar,
-                total,
-                status,
-                batch["tanggal_pengiriman"],
-                items_json,
-                created_at,
-                payment_deadline,
-            ),
-        )
-        db.commit()
+        # Same key from the form = same order (double submit, refresh, retry)
+        idempotency_key = request.form.get("idempotency_key", "").strip()[:64] or None
         
-        order_id = cursor.lastrowid
+        db = get_db()
+        db.execute("begin immediate")
+        try:
+            existing = None
+            if idempotency_key:
+                existing = db.execute(
+                    "select * from orders where idempotency_key = ?", (idempotency_key,)
+                ).fetchone()
+            if existing:
+                db.rollback()
+                session["last_order_id"] = existing["id"]
+                session["last_hp"] = existing["hp"]
+                save_cart({})
+                return redirect(url_for("berhasil_pesan"))
+            
+            items, total, unavailable = price_cart_for_order(db, cart)
+            if unavailable:
+                db.rollback()
+                for product_id in unavailable:
+                    product = get_product_by_id(product_id)
+                    flash(f"{product['nama'] if product else product_id} sudah tidak tersedia dan dihapus dari keranjang.", "warning")
+                    remove_from_cart(product_id)
+                return redirect(url_for("keranjang"))
+            items_json = serialize_items_for_db(items)
+            
+            shortages = reserve_batch_capacity(db, batch.get("id"), items)
+            if shortages:
+                db.rollback()
+                for item, sisa in shortages:
+                    flash(f"Kuota {item['nama']} untuk batch ini tinggal {sisa}kg.", "warning")
+                return redirect(url_for("keranjang"))
+            
+            cursor = db.execute(
+                "insert into orders (nama, hp, alamat, kecamatan, metode_bayar, total, status, tanggal_pengiriman, items_json, created_at, payment_deadline, batch_id, idempotency_key) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    nama,
+                    hp,
+                    alamat,
+                    kecamatan,
+                    metode_bayar,
+                    total,
+                    status,
+                    batch["tanggal_pengiriman"],
+                    items_json,
+                    created_at,
+                    payment_deadline,
+                    batch.get("id"),
+                    idempotency_key,
+                ),
+            )
+            order_id = cursor.lastrowid
+            insert_order_items(db, order_id, items)
+            record_sales(db, [order_id])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
         
         # Create Snap Transaction
-        param = {
-            "transaction_details": {
-                "order_id": f"ORDER-{order_id}-{int(time.time())}", # Unique ID requirement
-                "gross_amount": int(total),
-            },
-            "credit_card": {
-                "secure": True
-            },
-            "customer_details": {
-                "first_name": nama,
-                "phone": hp,
-            }
-        }
-        
-        try:
-            if "YOUR_SERVER_KEY" in MIDTRANS_SERVER_KEY:
-                # Mock Mode for Demo
-                snap_token = "DUMMY_TOKEN_FOR_DEMO"
-            else:
-                transaction = snap.create_transaction(param)
-                snap_token = transaction['token']
-                
-            session["snap_token"] = snap_token
-        except Exception as e:
-            print(f"Midtrans Error: {e}")
-            snap_token = None
+        start_snap_payment({
+            "id": order_id,
+            "total": total,
+            "nama": nama,
+            "hp": hp,
+            "payment_deadline": payment_deadline,
+        })
         
         session["last_order_id"] = order_id
         session["last_hp"] = hp
@@ -663,6 +1956,7 @@ def checkout():
     return render_template(
         "checkout.html",
         batch=batch,
+        idempotency_key=uuid.uuid4().hex,
     )
 
 
@@ -678,13 +1972,15 @@ def berhasil_pesan():
     if request.method == "POST":
         file = request.files.get("bukti")
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            name, ext = os.path.splitext(filename)
-            if not ext:
-                ext = ".jpg"
-            filename = f"order_{order_id}_{int(time.time())}{ext}"
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-            file.save(filepath)
+            try:
+                filename = save_upload(
+                    file, f"order_{order_id}_{int(time.time())}", PROOF_KINDS, UPLOAD_LIMITS["berhasil_pesan"]
+                )
+            except UploadRejected as e:
+                flash(str(e), "error")
+                return redirect(url_for("berhasil_pesan"))
+            register_asset("uploaded_file", filename)
+            enqueue_proof_downscale(filename)
             
             db.execute(
                 "update orders set bukti_path = ? where id = ?",
@@ -700,26 +1996,27 @@ def berhasil_pesan():
          
     order = dict(order_row)
     
-    # Check Expiry
-    is_expired = False
-    if order.get("payment_deadline"):
-        deadline = datetime.fromisoformat(order["payment_deadline"])
-        if datetime.utcnow() > deadline and order["status"] == "Menunggu Pembayaran":
-            is_expired = True
-            # Optional: Update status in DB to 'Dibatalkan'
-            # db.execute("update orders set status = 'Dibatalkan' where id = ?", (order_id,))
-            # db.commit()
+    # Check Expiry (orders are cancelled in bulk by expire_overdue_orders)
+    is_expired = is_payment_expired(order)
+
+    # Token may be stored already or still on its way from the background pool
+    snap_token_pending = False
+    if not snap_token and not is_expired:
+        status, snap_token = lookup_snap_token(db, order)
+        if snap_token:
+            session["snap_token"] = snap_token
+        snap_token_pending = status == "pending"
             
     # Reconstruct order object similar to before
-    items = json.loads(order["items_json"] or "[]")
-    order["items"] = items
+    order["items"] = get_order_items(db, [order])[order["id"]]
             
     return render_template(
         "berhasil_pesan.html",
         order=order,
         snap_token=snap_token,
         client_key=MIDTRANS_CLIENT_KEY,
-        is_expired=is_expired
+        is_expired=is_expired,
+        snap_token_pending=snap_token_pending,
     )
 
 
@@ -732,6 +2029,7 @@ def lacak_pesanan():
     if request.method == "POST":
         hp = request.form.get("hp", "").strip()
         if hp:
+            session["lacak_hp"] = hp  # lets api_order_status answer for these orders
             db = get_db()
             rows = db.execute(
                 "select * from orders where hp = ? order by created_at desc",
@@ -740,16 +2038,16 @@ def lacak_pesanan():
             
             # Convert to list of dicts
             orders = []
+            now = datetime.utcnow().isoformat()
             for row in rows:
                 o = dict(row)
                 # Check expiry for display logic
-                o["is_expired"] = False
-                if o.get("payment_deadline"):
-                    deadline = datetime.fromisoformat(o["payment_deadline"])
-                    if datetime.utcnow() > deadline and o["status"] == "Menunggu Pembayaran":
-                         o["is_expired"] = True
-                         o["status"] = "Dibatalkan (Expired)"
+                o["is_expired"] = is_payment_expired(o, now)
                 orders.append(o)
+
+            items_by_order = get_order_items(db, orders)
+            for o in orders:
+                o["item_count"] = len(items_by_order[o["id"]])
             
             return render_template("lacak.html", hp=hp, orders=orders)
             
@@ -769,40 +2067,114 @@ def bayar_ulang(order_id):
         session["last_order_id"] = order["id"]
         session["last_hp"] = order["hp"]
         
-        # Check if creating new token is allowed (not expired)
+        # Check if creating new token is allowed (still pending, not expired)
         o = dict(order)
-        if o.get("payment_deadline"):
-             deadline = datetime.fromisoformat(o["payment_deadline"])
-             if datetime.utcnow() > deadline:
+        if o["status"] == ORDER_STATUS_PENDING:
+             if is_payment_expired(o):
                  # It is expired, do not regenerate token, berhasil_pesan will show expired status
                  pass 
              else:
-                 # Not expired, regenerate token to be sure
-                 import time
-                 param = {
-                    "transaction_details": {
-                        "order_id": f"ORDER-{order_id}-{int(time.time())}", 
-                        "gross_amount": int(o["total"]),
-                    },
-                    "credit_card": { "secure": True },
-                    "customer_details": { "first_name": o["nama"], "phone": o["hp"] }
-                }
-                 try:
-                    if "YOUR_SERVER_KEY" in MIDTRANS_SERVER_KEY:
-                        token = "DUMMY_TOKEN_FOR_DEMO"
-                    else:
-                        transaction = snap.create_transaction(param)
-                        token = transaction['token']
-                    session["snap_token"] = token
-                 except Exception:
-                    pass
+                 # Not expired, reuse the order's token or create one
+                 start_snap_payment(o)
 
         return redirect(url_for("berhasil_pesan"))
 
     return redirect(url_for("lacak_pesanan"))
 
 
+# --- Order Status API ---
+# Clients long-poll /api/pesanan/<id>/status?since=<version>&wait=<seconds>.
+# Status writers queue the order ids on g and waiters are woken once the
+# request (or job) is torn down, i.e. after its commit. Writes from other
+# processes are only seen when a wait times out.
+ORDER_STATUS_MAX_WAIT = 25
+
+
+class OrderStatusNotifier:
+    def __init__(self):
+        self._waiters = {}  # order_id -> set of Events
+        self._lock = threading.Lock()
+
+    def subscribe(self, order_id):
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(order_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, order_id, event):
+        with self._lock:
+            waiters = self._waiters.get(order_id)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[order_id]
+
+    def notify(self, order_ids):
+        with self._lock:
+            events = [event for order_id in order_ids for event in self._waiters.get(order_id, ())]
+        for event in events:
+            event.set()
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+order_status_notifier = OrderStatusNotifier()
+
+
+def notify_order_status_later(order_ids):
+    g.setdefault("_changed_orders", set()).update(order_ids)
+
+
+@app.teardown_appcontext
+def flush_order_status_notifications(exception):
+    # A rolled back change only causes a spurious wakeup, clients re-read
+    order_ids = g.pop("_changed_orders", None)
+    if order_ids:
+        order_status_notifier.notify(order_ids)
+
+
+def read_order_status(order_id):
+    row = get_db().execute(
+        "select id, hp, status, status_version, payment_deadline from orders where id = ?", (order_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+@app.route("/api/pesanan/<int:order_id>/status")
+def api_order_status(order_id):
+    order = read_order_status(order_id)
+    session_hps = [hp for hp in (session.get("last_hp"), session.get("lacak_hp")) if hp]
+    if order is None or not (session.get("last_order_id") == order_id or order["hp"] in session_hps):
+        return jsonify({"error": "not found"}), 404
+
+    since = request.args.get("since", type=int)
+    wait = min(max(request.args.get("wait", 0, type=float), 0), ORDER_STATUS_MAX_WAIT)
+    if since is not None and since == order["status_version"] and wait:
+        event = order_status_notifier.subscribe(order_id)
+        try:
+            # Re-read after subscribing so a change in between isn't missed
+            order = read_order_status(order_id)
+            if order["status_version"] == since:
+                close_db(None)  # don't hold a pooled connection while waiting
+                event.wait(wait)
+                order = read_order_status(order_id)
+        finally:
+            order_status_notifier.unsubscribe(order_id, event)
+
+    response = jsonify({
+        "id": order["id"],
+        "status": order["status"],
+        "version": order["status_version"],
+        "is_expired": is_payment_expired(order),
+    })
+    response.headers["Cache-Control"] = "private, no-store"
+    return response
+
+
 @app.route("/edukasi")
+@cached_page()
 def edukasi():
     return render_template("edukasi.html")
 
@@ -840,21 +2212,43 @@ def require_login():
 def admin_dashboard():
     db = get_db()
     
-    # 1. Orders
-    rows = db.execute(
-        "select * from orders order by created_at desc limit 50"
-    ).fetchall()
-    orders = [dict(row) for row in rows]
+    # 1. Orders are lazy-loaded page by page from admin_orders
+
+    # Stats (maintained incrementally in sales_stats)
+    stats = get_sales_summary(db)
+
+    # 2. Products
+    products = get_all_products()
+    
+    # 3. Batch
+    batch = get_active_batch()
     
-    # Stats
-    total_penjualan = 0
-    total_kg = 0
+    # Remaining time for the form pre-fill
+    remaining = max(0, (batch["deadline_epoch"] or 0) - int(time.time()))
+    countdown_parts = {"d": remaining // 86400, "h": remaining % 86400 // 3600, "m": remaining % 3600 // 60}
+
+    return render_template(
+        "admin_dashboard.html",
+        products=products,
+        batch=batch,
+        total_penjualan=stats["total_penjualan"],
+        total_kg=int(stats["total_kg"]), # Cast to int for display
+        penjualan_produk=stats["per_product"],
+        penjualan_batch=stats["per_batch"],
+        countdown=countdown_parts,
+        status_options=ORDER_STATUSES,
+        capacity=get_batch_capacity(db, batch.get("id")),
+    )
+
+
+ORDER_STATUSES = ["Menunggu Pembayaran", "Sudah Dibayar", "Sedang Dikirim", "Selesai", "Dibatalkan"]
+ADMIN_ORDERS_PAGE_SIZE = 25
+
+
+def prepare_admin_orders(db, orders):
+    items_by_order = get_order_items(db, orders)
     for o in orders:
-        total_penjualan += (o["total"] or 0)
-        items = json.loads(o["items_json"] or "[]")
-        o["items_list"] = items # Add this for template
-        for item in items:
-            total_kg += item.get("qty", 0)
+        o["items_list"] = items_by_order[o["id"]] # Add this for template
             
         # Parse Maps URL if present
         o["maps_url"] = None
@@ -865,38 +2259,79 @@ def admin_dashboard():
             parts = o["alamat"].split("\n", 1)
             o["maps_url"] = parts[0].strip()
             o["alamat_display"] = parts[1].strip() if len(parts) > 1 else ""
-            
-    # 2. Products
-    products = get_all_products()
-    
-    # 3. Batch
-    batch = get_active_batch()
-    
-    # Parse countdown for form pre-fill
-    # Format expected: DD:HH:MM:SS or HH:MM:SS
-    countdown_parts = {"d": 0, "h": 0, "m": 0}
-    if batch and batch["countdown"]:
-        parts = batch["countdown"].split(":")
-        # Reverse to map from seconds up to days
-        parts.reverse()
-        
-        # Mapping: 0->S (unused in form), 1->M, 2->H, 3->D
-        if len(parts) > 1:
-            countdown_parts["m"] = int(parts[1])
-        if len(parts) > 2:
-            countdown_parts["h"] = int(parts[2])
-        if len(parts) > 3:
-            countdown_parts["d"] = int(parts[3])
+    return orders
 
-    return render_template(
-        "admin_dashboard.html",
+
+@app.route("/admin/pesanan")
+def admin_orders():
+    # Keyset pagination on (created_at, id), newest first. The cursor is the
+    # "created_at|id" of the last row of the previous page.
+    db = get_db()
+    query = "select * from orders where 1 = 1"
+    params = []
+
+    status = request.args.get("status", "")
+    if status:
+        query += " and status = ?"
+        params.append(status)
+
+    tanggal_pengiriman = request.args.get("tanggal_pengiriman", "")
+    if tanggal_pengiriman:
+        query += " and tanggal_pengiriman = ?"
+        params.append(tanggal_pengiriman)
+
+    # Date range on created_at (YYYY-MM-DD, inclusive)
+    dari = request.args.get("dari", "")
+    if dari:
+        query += " and created_at >= ?"
+        params.append(dari)
+    sampai = request.args.get("sampai", "")
+    if sampai:
+        query += " and created_at < ?"
+        params.append(sampai + "T99")  # sorts after any time on that day
+
+    hp = request.args.get("hp", "").strip()
+    if hp:
+        # Prefix match as a range so it can use the (hp, created_at) index
+        query += " and hp >= ? and hp < ?"
+        params.extend([hp, hp[:-1] + chr(ord(hp[-1]) + 1)])
+
+    cursor = request.args.get("cursor", "")
+    if cursor:
+        try:
+            cursor_created_at, cursor_id = cursor.rsplit("|", 1)
+            cursor_id = int(cursor_id)
+        except ValueError:
+            return jsonify({"error": "Cursor tidak valid."}), 400
+        query += " and (created_at, id) < (?, ?)"
+        params.extend([cursor_created_at, cursor_id])
+
+    try:
+        limit = min(max(int(request.args.get("limit", ADMIN_ORDERS_PAGE_SIZE)), 1), 100)
+    except ValueError:
+        limit = ADMIN_ORDERS_PAGE_SIZE
+
+    query += " order by created_at desc, id desc limit ?"
+    params.append(limit + 1)  # one extra row tells us whether there is a next page
+    rows = db.execute(query, params).fetchall()
+
+    orders = prepare_admin_orders(db, [dict(row) for row in rows[:limit]])
+    next_cursor = None
+    if len(rows) > limit:
+        last = orders[-1]
+        next_cursor = f"{last['created_at']}|{last['id']}"
+
+    if request.args.get("format") == "json":
+        return jsonify({"orders": orders, "next_cursor": next_cursor})
+
+    response = app.make_response(render_template(
+        "admin_order_rows.html",
         orders=orders,
-        products=products,
-        batch=batch,
-        total_penjualan=total_penjualan,
-        total_kg=int(total_kg), # Cast to int for display
-        countdown=countdown_parts
-    )
+        first_page=not cursor,
+        status_options=ORDER_STATUSES,
+    ))
+    response.headers["X-Next-Cursor"] = next_cursor or ""
+    return response
 
 
 
@@ -944,18 +2379,48 @@ def admin_update_batch():
             (nama, tanggal, status, countdown, deadline_str)
         )
     db.commit()
+    refresh_batch_version()
     return redirect(url_for("admin_dashboard"))
 
 
 
 
 
+@app.route("/admin/batch/kuota", methods=["POST"])
+def admin_update_capacity():
+    # One "kuota_<product_id>" field per product, empty = no limit
+    db = get_db()
+    batch = get_active_batch()
+    if not batch.get("id"):
+        flash("Simpan batch terlebih dahulu.", "warning")
+        return redirect(url_for("admin_dashboard"))
+
+    db.execute("begin immediate")
+    for p in get_catalog()["products"].values():
+        value = request.form.get(f"kuota_{p['id']}", "").strip()
+        if value.isdigit():
+            db.execute(
+                "insert into batch_capacity (batch_id, product_id, capacity_kg) values (?, ?, ?) on conflict(batch_id, product_id) do update set capacity_kg = excluded.capacity_kg",
+                (batch["id"], p["id"], int(value)),
+            )
+        elif not value:
+            db.execute("delete from batch_capacity where batch_id = ? and product_id = ?", (batch["id"], p["id"]))
+    db.commit()
+    flash("Kuota batch berhasil disimpan.", "success")
+    return redirect(url_for("admin_dashboard"))
+
+
 @app.route("/admin/update_status/<int:order_id>", methods=["POST"])
 def admin_update_status(order_id):
     status = request.form.get("status")
     if status:
         db = get_db()
-        db.execute("update orders set status = ? where id = ?", (status, order_id))
+        try:
+            update_order_status(db, order_id, status)
+        except CapacityConflict as e:
+            db.rollback()
+            flash(f"Status pesanan #{order_id} tidak diubah, kuota batch sudah habis: {e}", "error")
+            return redirect(url_for("admin_dashboard"))
         db.commit()
     return redirect(url_for("admin_dashboard"))
 
@@ -965,15 +2430,989 @@ def admin_hapus_produk(product_id):
     db = get_db()
     db.execute("update products set is_active = 0 where id = ?", (product_id,))
     db.commit()
+    refresh_catalog_version()
     return redirect(url_for("admin_dashboard"))
 
 
+# --- Upload Handling ---
+# Uploads are checked against a per-route size limit before the body is
+# parsed. While Werkzeug parses the body, file parts for those routes are
+# written straight into UPLOAD_FOLDER (UploadSpool), typed from their first
+# bytes rather than the client's filename, and the parse stops as soon as a
+# part is of an unknown type or over the limit. Saving then only renames the
+# file. Payment proofs are downscaled by a background worker so a burst of
+# phone photos doesn't hold request workers.
+UPLOAD_LIMITS = {
+    "berhasil_pesan": 8 * 1024 * 1024,
+    "admin_tambah_produk": 10 * 1024 * 1024,
+    "admin_edit_produk": 10 * 1024 * 1024,
+}
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png", ".png"),
+    (b"GIF87a", "gif", ".gif"),
+    (b"GIF89a", "gif", ".gif"),
+    (b"%PDF-", "pdf", ".pdf"),
+]
+PRODUCT_IMAGE_KINDS = ("jpeg", "png", "webp", "gif")
+PROOF_KINDS = ("jpeg", "png", "webp", "pdf")
+
+
+UPLOAD_SNIFF_BYTES = 12  # enough for every signature above and RIFF....WEBP
+
+
+class UploadRejected(Exception):
+    pass
+
+
+@app.before_request
+def enforce_upload_limit():
+    limit = UPLOAD_LIMITS.get(request.endpoint)
+    if limit and request.method == "POST" and (request.content_length or 0) > limit:
+        raise RequestEntityTooLarge()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    flash("Ukuran file terlalu besar.", "error")
+    return redirect(request.path)
+
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    # Raised while the body is parsed, i.e. on the view's first request.form/files access
+    flash(str(e), "error")
+    return redirect(request.path)
+
+
+def sniff_upload_kind(head):
+    for signature, kind, ext in UPLOAD_SIGNATURES:
+        if head.startswith(signature):
+            return kind, ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", ".webp"
+    return None, None
+
+
+class UploadSpool:
+    # Writable, readable file for one uploaded part, kept as a .part file in
+    # UPLOAD_FOLDER so save_upload can rename it into place. Removed on close
+    # unless it was saved.
+
+    def __init__(self, max_bytes):
+        fd, self.path = tempfile.mkstemp(suffix=".part", dir=app.config["UPLOAD_FOLDER"])
+        self.file = os.fdopen(fd, "w+b")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b""
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadRejected("Ukuran file terlalu besar.")
+        if len(self.head) < UPLOAD_SNIFF_BYTES:
+            self.head += data[:UPLOAD_SNIFF_BYTES - len(self.head)]
+            if len(self.head) == UPLOAD_SNIFF_BYTES and sniff_upload_kind(self.head)[0] is None:
+                raise UploadRejected("Format file tidak didukung.")
+        return self.file.write(data)
+
+    def kind(self):
+        return sniff_upload_kind(self.head)
+
+    def move_to(self, path):
+        self.file.close()
+        os.replace(self.path, path)
+        self.path = None
+
+    def close(self):
+        self.file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)  # read, seek, tell, ... for FileStorage
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = UPLOAD_LIMITS.get(self.endpoint)
+        if limit is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        spool = UploadSpool(limit)
+        self.__dict__.setdefault("_upload_spools", []).append(spool)
+        return spool
+
+    def close(self):
+        # Also the parts parsed before a rejection, which never reach self.files
+        super().close()
+        for spool in self.__dict__.pop("_upload_spools", ()):
+            spool.close()
+
+
+app.request_class = UploadRequest
+
+
+def save_upload(file, stem, kinds, max_bytes):
+    # Moves the upload to UPLOAD_FOLDER as <stem><ext> and returns the file
+    # name, or raises UploadRejected for an unknown type or oversized file.
+    # Uploads parsed by UploadRequest are on disk already, anything else is
+    # copied into a spool first.
+    spool = file.stream
+    try:
+        if not isinstance(spool, UploadSpool):
+            spool = UploadSpool(max_bytes)
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                spool.write(chunk)
+        kind, ext = spool.kind()
+        if kind not in kinds:
+            raise UploadRejected("Format file tidak didukung.")
+        filename = f"{stem}{ext}"
+        spool.move_to(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+    finally:
+        spool.close()  # removes the .part file unless it was moved
+    return filename
+
+
+_proof_queue = queue.Queue()
+_proof_worker = None
+_proof_worker_lock = threading.Lock()
+
+
+def downscale_proof(filename):
+    path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    max_dimension = app.config["PROOF_MAX_DIMENSION"]
+    with Image.open(path) as img:
+        if max(img.size) <= max_dimension:
+            return
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension))
+        tmp_path = f"{path}.part"
+        img.save(tmp_path, Image.registered_extensions()[os.path.splitext(path)[1].lower()], quality=85)
+    os.replace(tmp_path, path)
+    register_asset("uploaded_file", filename)
+
+
+def _run_proof_worker():
+    while True:
+        filename = _proof_queue.get()
+        try:
+            downscale_proof(filename)
+        except Exception as e:
+            print(f"Error downscaling payment proof {filename}: {e}")
+        finally:
+            _proof_queue.task_done()
+
+
+def enqueue_proof_downscale(filename):
+    global _proof_worker
+    if Image is None or os.path.splitext(filename)[1].lower() == ".pdf":
+        return
+    with _proof_worker_lock:
+        if _proof_worker is None:
+            _proof_worker = threading.Thread(target=_run_proof_worker, name="proof-downscale", daemon=True)
+            _proof_worker.start()
+    _proof_queue.put(filename)
+
+
+# --- Product Image Variants ---
+# Uploaded photos are resized to a few bounded sizes and re-encoded as WebP
+# (or JPEG for browsers without WebP). Variants are written at upload time
+# and generated on demand for older uploads, then kept in IMAGE_CACHE_FOLDER.
+IMAGE_SIZES = {
+    "card": 480,  # catalog / cart thumbnails
+    "detail": 960,  # product detail page
+    "full": 1600,
+}
+IMAGE_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
+_image_locks = {}
+_image_locks_guard = threading.Lock()
+
+
+def image_variant_path(filename, size, ext):
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(app.config["IMAGE_CACHE_FOLDER"], f"{stem}.{size}.{ext}")
+
+
+def generate_image_variant(filename, size, ext):
+    source = safe_join(app.config["UPLOAD_FOLDER"], filename)
+    target = image_variant_path(filename, size, ext)
+    if os.path.exists(target):
+        return target
+
+    # One writer per file, concurrent requests for it wait instead of redoing it
+    with _image_locks_guard:
+        lock = _image_locks.setdefault(target, threading.Lock())
+    with lock:
+        if not os.path.exists(target):
+            with Image.open(source) as img:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((IMAGE_SIZES[size], IMAGE_SIZES[size]))
+                fmt = IMAGE_FORMATS[ext][0]
+                if fmt == "JPEG" and img.mode != "RGB":
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    img = img.convert("RGBA")
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                elif img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA")
+                tmp_target = f"{target}.{threading.get_ident()}.tmp"
+                if fmt == "WEBP":
+                    img.save(tmp_target, fmt, quality=80, method=4)
+                else:
+                    img.save(tmp_target, fmt, quality=80, optimize=True, progressive=True)
+                os.replace(tmp_target, target)
+    with _image_locks_guard:
+        _image_locks.pop(target, None)
+    return target
+
+
+def generate_image_variants(filename):
+    if Image is None or os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+        return
+    for size in IMAGE_SIZES:
+        for ext in IMAGE_FORMATS:
+            try:
+                generate_image_variant(filename, size, ext)
+            except (OSError, ValueError) as e:
+                print(f"Error generating image variant {filename} ({size}/{ext}): {e}")
+                return
+
+
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
+    # ?size=card|detail|full serves a resized variant, negotiated on Accept
+    size = request.args.get("size")
+    source = safe_join(app.config["UPLOAD_FOLDER"], filename)
+    if (
+        size in IMAGE_SIZES
+        and Image is not None
+        and os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+        and source
+        and os.path.isfile(source)
+    ):
+        ext = "webp" if request.accept_mimetypes["image/webp"] else "jpg"
+        try:
+            path = generate_image_variant(filename, size, ext)
+        except (OSError, ValueError) as e:
+            print(f"Error generating image variant {filename} ({size}/{ext}): {e}")
+        else:
+            response = send_from_directory(
+                app.config["IMAGE_CACHE_FOLDER"], os.path.basename(path), mimetype=IMAGE_FORMATS[ext][1]
+            )
+            response.vary.add("Accept")
+            return response
     return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
 
 
+# --- Static Asset Fingerprinting ---
+# url_for('static', ...) and url_for('uploaded_file', ...) get a ?v=<content
+# hash> argument. Hashes of static files are computed once at startup, and
+# uploads are registered when they are saved. Requests carrying the current
+# hash are served with a one-year immutable Cache-Control. CSS is rebuilt
+# with fingerprinted url() references and precompressed (gzip, plus brotli
+# when available) into ASSET_BUILD_FOLDER.
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_ENDPOINTS = ("static", "uploaded_file")
+_asset_hashes = {}  # (endpoint, filename) -> content hash
+_built_assets = {}  # static filename -> {encoding: path}
+_CSS_URL_RE = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+def _content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def register_asset(endpoint, filename):
+    folder = app.static_folder if endpoint == "static" else app.config["UPLOAD_FOLDER"]
+    path = safe_join(folder, filename)
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        digest = _content_hash(f.read())
+    _asset_hashes[(endpoint, filename)] = digest
+    return digest
+
+
+def asset_hash(endpoint, filename):
+    digest = _asset_hashes.get((endpoint, filename))
+    if digest is None and filename:
+        digest = register_asset(endpoint, filename)
+    return digest
+
+
+def _fingerprint_css_urls(css, css_filename):
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(("data:", "http:", "https:", "//", "#")) or "?" in url:
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(css_filename), url))
+        digest = asset_hash("static", target)
+        if digest is None:
+            return match.group(0)
+        return f"url({quote}{url}?v={digest}{quote})"
+    return _CSS_URL_RE.sub(replace, css)
+
+
+def build_static_assets():
+    stylesheets = []
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            filename = os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, "/")
+            if filename.endswith(".css"):
+                stylesheets.append(filename)
+            else:
+                register_asset("static", filename)
+
+    for filename in stylesheets:
+        with open(os.path.join(app.static_folder, filename), encoding="utf-8") as f:
+            data = _fingerprint_css_urls(f.read(), filename).encode("utf-8")
+        target = os.path.join(app.config["ASSET_BUILD_FOLDER"], filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        variants = {"identity": data, "gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(data)
+        built = {}
+        for encoding, content in variants.items():
+            path = target if encoding == "identity" else f"{target}.{encoding}"
+            with open(path, "wb") as f:
+                f.write(content)
+            built[encoding] = path
+        _built_assets[filename] = built
+        _asset_hashes[("static", filename)] = _content_hash(data)
+
+
+@app.url_defaults
+def add_asset_hash(endpoint, values):
+    if endpoint in ASSET_ENDPOINTS and "v" not in values:
+        digest = asset_hash(endpoint, values.get("filename"))
+        if digest:
+            values["v"] = digest
+
+
+@app.before_request
+def serve_built_asset():
+    if request.endpoint != "static":
+        return None
+    built = _built_assets.get(request.view_args.get("filename"))
+    if not built:
+        return None
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in built and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    digest = asset_hash("static", request.view_args["filename"])
+    response = send_file(built[encoding], mimetype="text/css", conditional=True, etag=f"{encoding}-{digest}")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.after_request
+def add_asset_cache_headers(response):
+    if request.endpoint in ASSET_ENDPOINTS and response.status_code in (200, 304):
+        version = request.args.get("v")
+        if version and version == asset_hash(request.endpoint, request.view_args.get("filename")):
+            response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    return response
+
+
+build_static_assets()
+
+
+# --- Request Coalescing ---
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one; the others wait
+    # for the leader's result.
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        # Returns (future, is_leader). The leader must call finish().
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = Future()
+            return call, True
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            call = self._calls.pop(key)
+        if error is not None:
+            call.set_exception(error)
+        else:
+            call.set_result(result)
+
+    def do(self, key, fn):
+        call, leader = self.begin(key)
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+
 # --- AI Chat API ---
+# Answers are cached by normalized question (memory LRU + TTL, optionally
+# persisted in ai_answers) and identical in-flight questions share one
+# upstream call.
+app.config["AI_CHAT_CACHE_SIZE"] = 512
+app.config["AI_CHAT_CACHE_TTL"] = 24 * 3600
+app.config["AI_CHAT_CACHE_PERSIST"] = os.environ.get("SUKAIKAN_AI_CACHE_PERSIST", "1") == "1"
+# At most this many model calls at once; others get a quick 429 instead of
+# holding a worker thread
+app.config["AI_CHAT_MAX_UPSTREAM"] = 4
+app.config["AI_CHAT_UPSTREAM_WAIT"] = 0.25
+
+
+def normalize_question(question):
+    # "Gizi ikan KEMBUNG??" and "gizi ikan kembung" share a cache entry
+    return " ".join(re.findall(r"\w+", question.casefold()))
+
+
+class AnswerCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (answer, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, answer, stored_at=None):
+        with self._lock:
+            self._entries[key] = (answer, stored_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StreamingHTMLSanitizer:
+    # Turns model output into safe HTML chunk by chunk. Only the basic tags
+    # the system instruction asks for survive (without attributes), newlines
+    # become <br>, everything else is escaped. A tag split across chunks is
+    # held back until its ">" arrives.
+    ALLOWED_TAGS = {"b", "strong", "i", "em", "u", "br", "p", "ul", "ol", "li"}
+    VOID_TAGS = {"br"}
+    TAG_RE = re.compile(r"<\s*(/?)\s*([a-zA-Z0-9]+)[^<>]*>")
+    MAX_PENDING = 64
+
+    def __init__(self):
+        self.pending = ""
+        self.open_tags = []
+
+    def feed(self, text):
+        self.pending += text
+        out = []
+        while self.pending:
+            start = self.pending.find("<")
+            if start == -1:
+                out.append(self.text(self.pending))
+                self.pending = ""
+                break
+            if start:
+                out.append(self.text(self.pending[:start]))
+                self.pending = self.pending[start:]
+            end = self.pending.find(">")
+            if end == -1:
+                if len(self.pending) > self.MAX_PENDING:
+                    out.append(self.text(self.pending))  # not a tag after all
+                    self.pending = ""
+                break
+            out.append(self.tag(self.pending[:end + 1]))
+            self.pending = self.pending[end + 1:]
+        return "".join(out)
+
+    def close(self):
+        out = [self.text(self.pending)]
+        self.pending = ""
+        out += [f"</{name}>" for name in reversed(self.open_tags)]
+        self.open_tags = []
+        return "".join(out)
+
+    def text(self, text):
+        return html.escape(text, quote=False).replace("\n", "<br>")
+
+    def tag(self, raw):
+        match = self.TAG_RE.fullmatch(raw)
+        name = match.group(2).lower() if match else None
+        if name not in self.ALLOWED_TAGS:
+            return self.text(raw)
+        if name in self.VOID_TAGS:
+            return f"<{name}>"
+        if not match.group(1):
+            self.open_tags.append(name)
+            return f"<{name}>"
+        if name not in self.open_tags:
+            return ""  # stray closing tag
+        # Close anything left open inside it first
+        closed = []
+        while self.open_tags:
+            top = self.open_tags.pop()
+            closed.append(f"</{top}>")
+            if top == name:
+                break
+        return "".join(closed)
+
+
+def sanitize_answer(text):
+    sanitizer = StreamingHTMLSanitizer()
+    return sanitizer.feed(text) + sanitizer.close()
+
+
+# Local answers: questions about price, size or recipes of a product are
+# answered straight from the catalog snapshot (TF-IDF over product and recipe
+# names), everything else goes to the model with the matching products as
+# context, so prices are always current.
+ANSWER_STOPWORDS = {
+    "ikan", "apa", "yang", "dan", "di", "ke", "untuk", "dengan", "ini", "itu", "ada", "aja", "saja", "kak",
+    "min", "mau", "tanya", "dong", "ya", "yg", "gimana", "bagaimana", "bisa", "nya", "sukaikan",
+}
+ANSWER_INTENTS = {
+    "harga": {"harga", "harganya", "rp", "rupiah", "biaya", "mahal", "murah"},
+    "ukuran": {"ukuran", "ukurannya", "besar", "kecil", "isi", "ekor", "tekstur", "daging"},
+    "resep": {"resep", "masak", "dimasak", "olahan", "menu", "bikin", "membuat", "cara", "enaknya"},
+}
+ANSWER_MIN_SCORE = 0.3
+
+
+def tokenize_question(text):
+    return [t for t in normalize_question(text).split(" ") if t and t not in ANSWER_STOPWORDS]
+
+
+def build_answer_index(active, recommendations):
+    docs = {}
+    for p in active:
+        recipes = recommendations.get(p["id"], [])
+        text = " ".join([p["nama"]] * 2 + [p["kategori"].replace("-", " ")] + [r["nama"] for r in recipes])
+        docs[p["id"]] = tokenize_question(text)
+
+    df = {}
+    for tokens in docs.values():
+        for t in set(tokens):
+            df[t] = df.get(t, 0) + 1
+    idf = {t: math.log((len(docs) + 1) / (n + 1)) + 1 for t, n in df.items()}
+
+    vectors = {}
+    for product_id, tokens in docs.items():
+        vector = {}
+        for t in tokens:
+            vector[t] = vector.get(t, 0) + idf[t]
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1
+        vectors[product_id] = {t: w / norm for t, w in vector.items()}
+    return {"idf": idf, "vectors": vectors}
+
+
+def match_products(question, limit=3):
+    # [(score, product)] best first, by cosine similarity of TF-IDF vectors
+    catalog = get_catalog()
+    index = catalog["answers"]
+    query = {}
+    for t in tokenize_question(question):
+        if t in index["idf"]:
+            query[t] = query.get(t, 0) + index["idf"][t]
+    norm = math.sqrt(sum(w * w for w in query.values()))
+    if not norm:
+        return []
+    scored = []
+    for product_id, vector in index["vectors"].items():
+        score = sum(w * vector.get(t, 0) for t, w in query.items()) / norm
+        if score > 0:
+            scored.append((score, catalog["products"][product_id]))
+    scored.sort(key=lambda s: -s[0])
+    return scored[:limit]
+
+
+def question_intents(question):
+    words = set(normalize_question(question).split(" "))
+    return [intent for intent, keywords in ANSWER_INTENTS.items() if words & keywords]
+
+
+def format_rupiah(value):
+    return f"Rp {value:,.0f}"
+
+
+def answer_locally(question):
+    # Returns an HTML answer, or None when the model should answer
+    intents = question_intents(question)
+    if not intents:
+        return None
+    matches = match_products(question)
+    catalog = get_catalog()
+    if not matches or matches[0][0] < ANSWER_MIN_SCORE:
+        if intents == ["harga"]:
+            lines = [f"<li>{html.escape(p['nama'])}: <strong>{format_rupiah(p['harga_per_kg'])}</strong>/kg</li>" for p in catalog["active"]]
+            return "Daftar harga SUKAIKAN hari ini 🐟<ul>" + "".join(lines) + "</ul>"
+        return None
+
+    p = matches[0][1]
+    nama = html.escape(p["nama"])
+    parts = []
+    if "harga" in intents:
+        parts.append(f"Harga <strong>{nama}</strong> saat ini <strong>{format_rupiah(p['harga_per_kg'])}</strong>/kg.")
+    if "ukuran" in intents:
+        parts.append(f"Ukuran <strong>{nama}</strong>: {html.escape(p['ukuran'] or '-')}. {html.escape(p['tekstur'] or '')}")
+    if "resep" in intents:
+        recipes = catalog["recommendations"].get(p["id"], [])
+        if not recipes:
+            return None
+        lines = [f"<li>{html.escape(r['nama'])} ({html.escape(r['estimasi'] or '-')})</li>" for r in recipes]
+        parts.append(f"Ide olahan <strong>{nama}</strong> 🍳<ul>" + "".join(lines) + "</ul>")
+    return "<br>".join(parts)
+
+
+def build_answer_context(question):
+    # Current product facts for the prompt: the best matches, or the whole
+    # (small) active catalog when nothing matches
+    catalog = get_catalog()
+    products = [p for _, p in match_products(question)] or catalog["active"][:10]
+    lines = []
+    for p in products:
+        recipes = ", ".join(r["nama"] for r in catalog["recommendations"].get(p["id"], []))
+        lines.append(
+            f"- {p['nama']}: {format_rupiah(p['harga_per_kg'])}/kg, ukuran {p['ukuran']}, {p['tekstur']}"
+            + (f"; resep: {recipes}" if recipes else "")
+        )
+    return (
+        "Data produk SUKAIKAN saat ini (pakai untuk harga, ukuran dan resep, jangan mengarang harga):\n"
+        + "\n".join(lines)
+    )
+
+
+class GeminiBackend:
+    # One model instance for the whole process
+    def __init__(self, model_name="gemini-2.5-flash"):
+        self.model = genai.GenerativeModel(model_name=model_name, system_instruction=SYSTEM_INSTRUCTION)
+
+    def prompt(self, question, context):
+        return f"{context}\n\nPertanyaan pelanggan: {question}" if context else question
+
+    def generate(self, question, context=None):
+        return self.model.generate_content(self.prompt(question, context)).text
+
+    def stream(self, question, context=None):
+        for chunk in self.model.generate_content(self.prompt(question, context), stream=True):
+            yield chunk.text
+
+
+class AIChatBusy(Exception):
+    pass
+
+
+class AIChatService:
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.cache = AnswerCache(app.config["AI_CHAT_CACHE_SIZE"], app.config["AI_CHAT_CACHE_TTL"])
+        self.upstream_slots = threading.BoundedSemaphore(app.config["AI_CHAT_MAX_UPSTREAM"])
+        self._flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {
+                "questions": 0, "local_answers": 0, "memory_hits": 0, "db_hits": 0,
+                "coalesced": 0, "upstream_calls": 0, "errors": 0, "busy": 0, "rate_limited": 0,
+            }
+
+    def count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def answer_locally(self, question):
+        answer = answer_locally(question)
+        if answer is not None:
+            self.count("questions")
+            self.count("local_answers")
+        return answer
+
+    def cache_key(self, question, context):
+        # Answers depend on the product data they were grounded on
+        return f"{normalize_question(question)}#{hashlib.sha1(context.encode()).hexdigest()[:10]}"
+
+    def answer(self, question):
+        self.count("questions")
+        context = build_answer_context(question)
+        key = self.cache_key(question, context)
+        answer = self.cache.get(key)
+        if answer is not None:
+            self.count("memory_hits")
+            return answer
+
+        leader = []
+
+        def load():
+            leader.append(True)
+            answer = self.load_persisted(key)
+            if answer is None:
+                self.acquire_upstream()
+                self.count("upstream_calls")
+                try:
+                    answer = sanitize_answer(self.backend.generate(question, context))
+                except Exception:
+                    self.count("errors")
+                    raise
+                finally:
+                    self.upstream_slots.release()
+                self.store(key, answer)
+            return answer
+
+        answer = self._flight.do(key, load)
+        if not leader:
+            self.count("coalesced")
+        return answer
+
+    def stream(self, question):
+        # Yields safe HTML chunks as the model produces them. Cached and
+        # coalesced answers come out as a single chunk.
+        self.count("questions")
+        context = build_answer_context(question)
+        key = self.cache_key(question, context)
+        answer = self.cache.get(key)
+        if answer is not None:
+            self.count("memory_hits")
+            yield answer
+            return
+
+        call, leader = self._flight.begin(key)
+        if not leader:
+            self.count("coalesced")
+            yield call.result()
+            return
+
+        answer = None
+        try:
+            answer = self.load_persisted(key)
+            if answer is not None:
+                yield answer
+            else:
+                self.acquire_upstream()
+                self.count("upstream_calls")
+                try:
+                    stream = getattr(self.backend, "stream", None)
+                    chunks = stream(question, context) if stream else [self.backend.generate(question, context)]
+                    sanitizer = StreamingHTMLSanitizer()
+                    parts = []
+                    for text in chunks:
+                        part = sanitizer.feed(text)
+                        if part:
+                            parts.append(part)
+                            yield part
+                    parts.append(sanitizer.close())
+                    yield parts[-1]
+                finally:
+                    self.upstream_slots.release()
+                answer = "".join(parts)
+                self.store(key, answer)
+        except GeneratorExit:
+            # Client went away mid-stream, followers get an error
+            self._flight.finish(key, error=RuntimeError("stream aborted"))
+            raise
+        except AIChatBusy as e:
+            self._flight.finish(key, error=e)
+            raise
+        except Exception as e:
+            self.count("errors")
+            self._flight.finish(key, error=e)
+            raise
+        self._flight.finish(key, answer)
+
+    def acquire_upstream(self):
+        if not self.upstream_slots.acquire(timeout=app.config["AI_CHAT_UPSTREAM_WAIT"]):
+            self.count("busy")
+            raise AIChatBusy("Too many model calls in flight")
+
+    def load_persisted(self, key):
+        if not app.config["AI_CHAT_CACHE_PERSIST"]:
+            return None
+        row = get_db().execute(
+            "select answer, created_at from ai_answers where question_key = ? and created_at > ?",
+            (key, time.time() - self.cache.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        self.count("db_hits")
+        self.cache.put(key, row["answer"], row["created_at"])
+        return row["answer"]
+
+    def store(self, key, answer):
+        self.cache.put(key, answer)
+        if app.config["AI_CHAT_CACHE_PERSIST"]:
+            db = get_db()
+            db.execute(
+                "insert or replace into ai_answers (question_key, answer, created_at) values (?, ?, ?)",
+                (key, answer, time.time()),
+            )
+            db.commit()
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        answered = stats["questions"] - stats["errors"] - stats["busy"]
+        stats["hit_rate"] = round((answered - stats["upstream_calls"]) / answered, 3) if answered else 0.0
+        stats["upstream_calls_saved"] = max(answered - stats["upstream_calls"], 0)
+        stats["cached_answers"] = len(self.cache)
+        return stats
+
+
+ai_chat = AIChatService(GeminiBackend() if GEMINI_API_KEY else None)
+
+AI_CHAT_BUSY_ANSWER = "Maaf, IKAN AI sedang ramai. Coba tanya lagi sebentar lagi ya 🙏"
+
+
+# --- Rate Limiting ---
+# Token buckets per session, per IP and for the whole app in front of the AI
+# chat endpoints. The memory backend is per process; the sqlite backend keeps
+# buckets in the shared database for multi-process deployments.
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("SUKAIKAN_RATE_LIMIT_BACKEND", "memory")
+app.config["AI_CHAT_RATE_LIMITS"] = {
+    # scope: (tokens per second, burst)
+    "session": (0.2, 5),
+    "ip": (1.0, 20),
+    "global": (5.0, 30),
+}
+RATE_LIMITED_ENDPOINTS = {"api_ai_chat", "api_ai_chat_stream"}
+
+
+def refill_bucket(tokens, updated, rate, burst, now):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def take_buckets(state, buckets, now):
+    # Takes a token from each (key, rate, burst) bucket in order, stopping at
+    # the first one that is empty. state maps key -> (tokens, updated) and is
+    # updated in place for the buckets touched. Returns (wait, touched keys).
+    touched = []
+    for key, rate, burst in buckets:
+        tokens, updated = state.get(key, (burst, now))
+        tokens = refill_bucket(tokens, updated, rate, burst, now)
+        touched.append(key)
+        if tokens < 1:
+            state[key] = (tokens, now)
+            return (1 - tokens) / rate, touched
+        state[key] = (tokens - 1, now)
+    return 0, touched
+
+
+class MemoryRateLimitBackend:
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        # Returns 0 when a token was taken from every bucket, else seconds
+        # until the empty one has one again
+        with self._lock:
+            wait, _ = take_buckets(self._buckets, buckets, now)
+            if wait and len(self._buckets) > 10000:
+                # Full buckets carry no state worth keeping
+                limits = {key.split(":", 1)[0]: (rate, burst) for key, rate, burst in buckets}
+                for k, (t, u) in list(self._buckets.items()):
+                    rate, burst = limits.get(k.split(":", 1)[0], (0, 0))
+                    if rate and refill_bucket(t, u, rate, burst, now) >= burst:
+                        del self._buckets[k]
+            return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteRateLimitBackend:
+    def take(self, buckets, now):
+        # One write transaction for all scopes, the checkout writes to this
+        # database too
+        keys = [key for key, rate, burst in buckets]
+        db = get_db()
+        db.execute("begin immediate")
+        try:
+            rows = db.execute(
+                f"select key, tokens, updated from rate_limits where key in ({', '.join('?' * len(keys))})", keys
+            ).fetchall()
+            state = {row["key"]: (row["tokens"], row["updated"]) for row in rows}
+            wait, touched = take_buckets(state, buckets, now)
+            db.executemany(
+                "insert into rate_limits (key, tokens, updated) values (?, ?, ?) on conflict(key) do update set tokens = excluded.tokens, updated = excluded.updated",
+                [(key, *state[key]) for key in touched],
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return wait
+
+    def reset(self):
+        db = get_db()
+        db.execute("delete from rate_limits")
+        db.commit()
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backends = {"memory": MemoryRateLimitBackend(), "sqlite": SQLiteRateLimitBackend()}
+
+    @property
+    def backend(self):
+        return self.backends[app.config["RATE_LIMIT_BACKEND"]]
+
+    def check(self, limits, keys):
+        # Takes a token from every scope's bucket, returns the longest wait
+        # (0 = allowed). Scopes checked before a refusal keep their token
+        # spent, which is what a client hammering the endpoint deserves.
+        buckets = [(f"{scope}:{key}", *limits[scope]) for scope, key in keys.items()]
+        return self.backend.take(buckets, time.time())
+
+
+rate_limiter = RateLimiter()
+
+
+@app.before_request
+def limit_ai_chat():
+    if request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    keys = {"ip": request.remote_addr, "global": "ai-chat"}
+    # Only an existing server-side session gets its own bucket; minting one
+    # here would write a sessions row for every cookieless (or rejected) call
+    if isinstance(session, ServerSession) and not session.new:
+        keys["session"] = session.sid
+    wait = rate_limiter.check(app.config["AI_CHAT_RATE_LIMITS"], keys)
+    if not wait:
+        return None
+    ai_chat.count("rate_limited")
+    response = jsonify({"answer": AI_CHAT_BUSY_ANSWER})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(math.ceil(wait))
+    return response
+
+
+
 @app.route("/api/ai-chat", methods=["POST"])
 def api_ai_chat():
     data = request.get_json()
@@ -982,24 +3421,658 @@ def api_ai_chat():
     if not question:
         return jsonify({"answer": "Silakan tulis pertanyaan tentang ikan 🐟"})
     
-    if not GEMINI_API_KEY:
+    local = ai_chat.answer_locally(question)
+    if local is not None:
+        return jsonify({"answer": local})
+    
+    if ai_chat.backend is None:
         return jsonify({"answer": "Mohon maaf, Gemini API belum dikonfigurasi. Admin perlu memasukkan GEMINI_API_KEY di server."})
     
     try:
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash", 
-            system_instruction=SYSTEM_INSTRUCTION
-        )
-        response = model.generate_content(question)
-        answer = response.text
-        # Safety: replace newlines with <br> for HTML rendering if Gemini didn't use <br>
-        answer = answer.replace('\n', '<br>')
-        return jsonify({"answer": answer})
+        return jsonify({"answer": ai_chat.answer(question)})
+    except AIChatBusy:
+        response = jsonify({"answer": AI_CHAT_BUSY_ANSWER})
+        response.status_code = 429
+        response.headers["Retry-After"] = "5"
+        return response
     except Exception as e:
         print(f"Gemini AI Error: {e}")
         return jsonify({"answer": "Maaf, terjadi kesalahan saat menghubungi AI. Silakan coba lagi nanti."})
 
 
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.route("/api/ai-chat/stream", methods=["POST"])
+def api_ai_chat_stream():
+    # Same as api_ai_chat, but as Server-Sent Events: one "data" event per
+    # chunk of safe HTML, then "done".
+    data = request.get_json(silent=True)
+    question = data.get("question", "").strip() if data else ""
+
+    def events():
+        local = ai_chat.answer_locally(question) if question else None
+        if not question:
+            yield sse_event({"html": "Silakan tulis pertanyaan tentang ikan 🐟"})
+        elif local is not None:
+            yield sse_event({"html": local})
+        elif ai_chat.backend is None:
+            yield sse_event({"html": "Mohon maaf, Gemini API belum dikonfigurasi. Admin perlu memasukkan GEMINI_API_KEY di server."})
+        else:
+            try:
+                for chunk in ai_chat.stream(question):
+                    if chunk:
+                        yield sse_event({"html": chunk})
+            except AIChatBusy:
+                yield sse_event({"html": AI_CHAT_BUSY_ANSWER}, event="error")
+            except Exception as e:
+                print(f"Gemini AI Error: {e}")
+                yield sse_event({"html": "Maaf, terjadi kesalahan saat menghubungi AI. Silakan coba lagi nanti."}, event="error")
+        yield sse_event({}, event="done")
+
+    response = app.response_class(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"  # no proxy buffering
+    return response
+
+
+@app.route("/admin/ai-chat")
+def admin_ai_chat_stats():
+    return jsonify(ai_chat.metrics())
+
+
+# --- Payment Gateway Client ---
+# Wraps the Midtrans Snap client with a pooled HTTP session, strict
+# connect/read timeouts, bounded retries with jittered backoff and a circuit
+# breaker, so a slow gateway fails fast instead of tying up workers.
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # Default (connect, read) timeout, cut short by the calling thread's
+    # deadline.value (a time.monotonic() value) when one is set
+    def __init__(self, timeout, deadline=None, **kwargs):
+        self.timeout = timeout
+        self.deadline = deadline or threading.local()
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            connect, read = self.timeout
+            deadline = getattr(self.deadline, "value", None)
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0.01)
+                connect, read = min(connect, remaining), min(read, remaining)
+            kwargs["timeout"] = (connect, read)
+        return super().send(request, **kwargs)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures, then lets a single trial
+    # call through once `reset_after` seconds have passed.
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                self.opened_at = time.monotonic()  # half-open: one trial call
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class PaymentClient:
+    def __init__(self, snap_client, server_key):
+        self.snap = snap_client
+        self.server_key = server_key
+        self.breaker = CircuitBreaker()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="snap-token")
+        self._futures = {}  # order_id -> (future, submitted_at)
+        self._futures_lock = threading.Lock()
+        self._deadline = threading.local()  # per calling thread, read by TimeoutHTTPAdapter
+        self.configure()
+
+    def configure(self, server_key=None, snap_base_url=None, core_base_url=None):
+        if server_key:
+            self.server_key = server_key
+            self.snap.api_config.server_key = server_key
+        snap_base_url = snap_base_url or app.config["MIDTRANS_SNAP_URL"]
+        if snap_base_url:
+            self.snap.api_config.SNAP_SANDBOX_BASE_URL = snap_base_url
+            self.snap.api_config.SNAP_PRODUCTION_BASE_URL = snap_base_url
+        core_base_url = core_base_url or app.config["MIDTRANS_CORE_URL"]
+        if core_base_url:
+            self.snap.api_config.CORE_SANDBOX_BASE_URL = core_base_url
+            self.snap.api_config.CORE_PRODUCTION_BASE_URL = core_base_url
+
+        adapter = TimeoutHTTPAdapter(
+            timeout=(app.config["PAYMENT_CONNECT_TIMEOUT"], app.config["PAYMENT_READ_TIMEOUT"]),
+            deadline=self._deadline,
+            pool_connections=4,
+            pool_maxsize=32,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.snap.http_client.http_client = session  # midtransclient calls .request() on it
+
+    @property
+    def mock_mode(self):
+        # Mock Mode for Demo
+        return "YOUR_SERVER_KEY" in self.server_key
+
+    def call(self, fn, *args, idempotent=True):
+        # Runs a gateway call, retries included, within PAYMENT_CALL_BUDGET.
+        # Connection errors are always retried. Read timeouts and 5xx are only
+        # retried for idempotent calls: the gateway may have acted on the
+        # first request, and a second create_transaction with the same
+        # order_id would be rejected.
+        if not self.breaker.allow():
+            raise CircuitOpenError("Payment gateway circuit is open")
+        deadline = time.monotonic() + app.config["PAYMENT_CALL_BUDGET"]
+        attempts = app.config["PAYMENT_MAX_RETRIES"] + 1
+        self._deadline.value = deadline
+        try:
+            for attempt in range(attempts):
+                try:
+                    result = fn(*args)
+                except requests.ConnectionError as e:  # includes ConnectTimeout
+                    error = e
+                except requests.Timeout as e:
+                    error = e
+                    if not idempotent:
+                        break
+                except MidtransAPIError as e:
+                    if e.http_status_code < 500:
+                        self.breaker.record_success()  # the gateway answered, the request was bad
+                        raise
+                    error = e
+                    if not idempotent:
+                        break
+                else:
+                    self.breaker.record_success()
+                    return result
+                delay = random.uniform(0, 0.25 * 2 ** attempt)  # full jitter
+                if attempt + 1 == attempts or time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+        finally:
+            self._deadline.value = None
+        self.breaker.record_failure()
+        raise error
+
+    def create_snap_token(self, param):
+        if self.mock_mode:
+            return "DUMMY_TOKEN_FOR_DEMO"
+        return self.call(self.snap.create_transaction, param, idempotent=False)["token"]
+
+    def transaction_statuses(self, transaction_ids, deadline=None):
+        # Status API lookups with at most PAYMENT_RECONCILE_WORKERS in flight.
+        # Returns {transaction_id: response or None if it failed}. Ids not
+        # started before `deadline` (time.monotonic()) or refused by the open
+        # circuit are left out.
+        skipped = object()
+
+        def lookup(transaction_id):
+            if deadline is not None and time.monotonic() >= deadline:
+                return transaction_id, skipped
+            try:
+                return transaction_id, self.call(self.snap.transactions.status, transaction_id)
+            except CircuitOpenError:
+                return transaction_id, skipped
+            except MidtransAPIError as e:
+                if str((e.api_response_dict or {}).get("status_code")) != "404":
+                    print(f"Midtrans status error for {transaction_id}: {e}")
+                return transaction_id, None  # 404: the customer never opened the payment page
+            except Exception as e:
+                print(f"Midtrans status error for {transaction_id}: {e}")
+                return transaction_id, None
+
+        with ThreadPoolExecutor(app.config["PAYMENT_RECONCILE_WORKERS"], thread_name_prefix="payment-status") as pool:
+            return {
+                transaction_id: result
+                for transaction_id, result in pool.map(lookup, transaction_ids)
+                if result is not skipped
+            }
+
+    def verify_notification(self, payload):
+        # signature_key = sha512(order_id + status_code + gross_amount + server_key)
+        raw = "".join(str(payload.get(key, "")) for key in ("order_id", "status_code", "gross_amount")) + self.server_key
+        expected = hashlib.sha512(raw.encode()).hexdigest()
+        return hmac.compare_digest(expected, str(payload.get("signature_key", "")))
+
+    def submit_snap_token(self, order_id, fn):
+        now = time.monotonic()
+        with self._futures_lock:
+            # Forget results nobody came back for
+            for key, (future, submitted_at) in list(self._futures.items()):
+                if future.done() and now - submitted_at > 900:
+                    del self._futures[key]
+            entry = self._futures.get(order_id)
+            if entry and not entry[0].done():
+                return  # already on its way
+            self._futures[order_id] = (self.executor.submit(fn), now)
+
+    def pending_snap_token(self, order_id):
+        # Returns (status, token) for an async request: "none", "pending", "ready" or "failed"
+        with self._futures_lock:
+            entry = self._futures.get(order_id)
+            if entry is None:
+                return "none", None
+            future = entry[0]
+            if not future.done():
+                return "pending", None
+            del self._futures[order_id]
+        try:
+            return "ready", future.result()
+        except Exception as e:
+            print(f"Midtrans Error: {e}")
+            return "failed", None
+
+
+payment_client = PaymentClient(snap, MIDTRANS_SERVER_KEY)
+
+
+# Tokens are reused until shortly before the order's payment deadline
+SNAP_TOKEN_REUSE_MARGIN = timedelta(seconds=30)
+_snap_token_flight = SingleFlight()
+
+
+def build_snap_param(order):
+    return {
+        "transaction_details": {
+            "order_id": f"ORDER-{order['id']}-{int(time.time())}", # Unique ID requirement
+            "gross_amount": int(order["total"]),
+        },
+        "credit_card": {
+            "secure": True
+        },
+        "customer_details": {
+            "first_name": order["nama"],
+            "phone": order["hp"],
+        }
+    }
+
+
+def get_cached_snap_token(db, order_id):
+    row = db.execute(
+        "select token from snap_tokens where order_id = ? and expires_at > ?",
+        (order_id, (datetime.utcnow() + SNAP_TOKEN_REUSE_MARGIN).isoformat()),
+    ).fetchone()
+    return row["token"] if row else None
+
+
+def issue_snap_token(order):
+    # Returns the order's reusable token, calling the gateway at most once per
+    # order at a time. Runs in request context or in the payment pool.
+    def create():
+        db = get_db()
+        token = get_cached_snap_token(db, order["id"])
+        if token:
+            return token
+        param = build_snap_param(order)
+        token = payment_client.create_snap_token(param)
+        db.execute(
+            "insert or replace into snap_tokens (order_id, token, transaction_id, expires_at, created_at) values (?, ?, ?, ?, ?)",
+            (
+                order["id"],
+                token,
+                param["transaction_details"]["order_id"],
+                order["payment_deadline"],
+                datetime.utcnow().isoformat(),
+            ),
+        )
+        db.commit()
+        return token
+
+    return _snap_token_flight.do(order["id"], create)
+
+
+def issue_snap_token_in_background(order):
+    with app.app_context():
+        return issue_snap_token(order)
+
+
+def start_snap_payment(order):
+    # Puts the Snap token for berhasil_pesan in the session, creating it in the
+    # background with PAYMENT_ASYNC
+    session.pop("snap_token", None)
+    token = get_cached_snap_token(get_db(), order["id"])
+    if token:
+        session["snap_token"] = token
+        return
+    if app.config["PAYMENT_ASYNC"] and not payment_client.mock_mode:
+        payment_client.submit_snap_token(order["id"], functools.partial(issue_snap_token_in_background, order))
+        return
+    try:
+        session["snap_token"] = issue_snap_token(order)
+    except Exception as e:
+        print(f"Midtrans Error: {e}")
+
+
+def lookup_snap_token(db, order):
+    # (status, token) for an order without a token in the session. The
+    # snap_tokens row is written by whichever process created the token; the
+    # future only exists in the process that started it, so a young order may
+    # still be in flight elsewhere.
+    token = get_cached_snap_token(db, order["id"])
+    if token:
+        return "ready", token
+    status, token = payment_client.pending_snap_token(order["id"])
+    if status == "none" and app.config["PAYMENT_ASYNC"]:
+        in_flight_until = datetime.fromisoformat(order["created_at"]) + timedelta(seconds=app.config["PAYMENT_CALL_BUDGET"] + 5)
+        if datetime.utcnow() < in_flight_until:
+            status = "pending"
+    return status, token
+
+
+@app.route("/pesanan/<int:order_id>/snap-token")
+def snap_token_status(order_id):
+    if session.get("last_order_id") != order_id:
+        return jsonify({"status": "none"}), 404
+    if session.get("snap_token"):
+        return jsonify({"status": "ready", "token": session["snap_token"]})
+    db = get_db()
+    order = db.execute("select id, created_at from orders where id = ?", (order_id,)).fetchone()
+    if order is None:
+        return jsonify({"status": "none"}), 404
+    status, token = lookup_snap_token(db, order)
+    if token:
+        session["snap_token"] = token
+    return jsonify({"status": status, "token": token})
+
+
+# --- Payment Notifications ---
+# Midtrans posts every transaction change to /api/midtrans/notification and
+# reconcile_payments asks the status API for whatever was missed. Both go
+# through apply_payment_status, so repeated or out-of-order updates are safe.
+PAYMENT_PAID_STATUSES = ("settlement", "capture")
+PAYMENT_FAILED_STATUSES = ("deny", "cancel", "expire", "failure")
+
+
+def order_id_for_transaction(db, transaction_id):
+    row = db.execute("select order_id from snap_tokens where transaction_id = ?", (transaction_id,)).fetchone()
+    if row:
+        return row["order_id"]
+    # The token row may already be purged, fall back to build_snap_param's format
+    match = re.fullmatch(r"ORDER-(\d+)-\d+", transaction_id or "")
+    return int(match.group(1)) if match else None
+
+
+def apply_payment_status(db, order_id, transaction):
+    # Applies a Midtrans transaction (notification body or status API
+    # response) to an order. Orders only move forward: pending (or recently
+    # cancelled, for a late payment) to paid. A failed transaction drops its
+    # Snap token so "bayar ulang" starts a new one; the order itself is left
+    # to the payment deadline. Caller commits.
+    transaction_status = transaction.get("transaction_status")
+    if transaction_status in PAYMENT_FAILED_STATUSES:
+        db.execute("delete from snap_tokens where transaction_id = ?", (transaction.get("order_id"),))
+        return False
+    if transaction_status not in PAYMENT_PAID_STATUSES:
+        return False
+    if transaction_status == "capture" and transaction.get("fraud_status", "accept") != "accept":
+        return False  # card payment held for review, a later notification settles it
+    if not db.in_transaction:
+        db.execute("begin immediate")
+    order = db.execute("select status, total from orders where id = ?", (order_id,)).fetchone()
+    if order is None or order["status"] not in (ORDER_STATUS_PENDING, ORDER_STATUS_CANCELLED):
+        return False
+    try:
+        gross_amount = int(float(transaction.get("gross_amount")))
+    except (TypeError, ValueError):
+        gross_amount = None
+    if gross_amount != order["total"]:
+        print(f"Payment for order {order_id} does not match its total: {transaction.get('gross_amount')}")
+        return False
+    try:
+        return update_order_status(db, order_id, ORDER_STATUS_PAID)
+    except CapacityConflict as e:
+        # Paid, but its kg went to other orders meanwhile: stays cancelled for
+        # the admin to refund or make room (reconcile retries within the lookback)
+        print(f"Late payment for cancelled order {order_id} does not fit its batch: {e}")
+        return False
+
+
+@app.route("/api/midtrans/notification", methods=["POST"])
+def midtrans_notification():
+    if payment_client.mock_mode:
+        # The placeholder server key is public, any signature made with it is forgeable
+        return jsonify({"error": "payment gateway not configured"}), 403
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not payment_client.verify_notification(payload):
+        return jsonify({"error": "invalid signature"}), 403
+    db = get_db()
+    order_id = order_id_for_transaction(db, payload.get("order_id"))
+    if order_id is None:
+        # Not one of ours (e.g. the dashboard's test notification), don't make Midtrans retry
+        return jsonify({"status": "ignored"})
+    try:
+        changed = apply_payment_status(db, order_id, payload)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return jsonify({"status": "ok", "changed": changed})
+
+
+# --- Background Jobs ---
+class JobScheduler:
+    # Runs registered jobs on fixed intervals in one daemon thread and keeps
+    # per-job metrics for /admin/jobs.
+
+    def __init__(self):
+        self.jobs = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def job(self, name, interval, own_thread=False):
+        # own_thread jobs (slow, network bound) run beside the loop instead of
+        # holding up the others; a run is skipped while the last one is busy
+        def decorator(fn):
+            self.jobs.append({
+                "name": name,
+                "interval": interval,
+                "own_thread": own_thread,
+                "worker": None,
+                "fn": fn,
+                "next_run": 0.0,
+                "runs": 0,
+                "errors": 0,
+                "last_run_at": None,
+                "last_duration_ms": None,
+                "last_affected": None,
+                "total_affected": 0,
+                "last_error": None,
+            })
+            return fn
+        return decorator
+
+    def run_job(self, job):
+        started = time.perf_counter()
+        try:
+            with app.app_context():
+                affected = job["fn"]() or 0
+            job["last_affected"] = affected
+            job["total_affected"] += affected
+            job["last_error"] = None
+        except Exception as e:
+            job["errors"] += 1
+            job["last_error"] = str(e)
+            print(f"Job {job['name']} failed: {e}")
+        finally:
+            job["runs"] += 1
+            job["last_run_at"] = datetime.utcnow().isoformat()
+            job["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def run_pending(self):
+        now = time.monotonic()
+        for job in self.jobs:
+            if job["next_run"] <= now:
+                job["next_run"] = now + job["interval"]
+                if not job["own_thread"]:
+                    self.run_job(job)
+                elif job["worker"] is None or not job["worker"].is_alive():
+                    job["worker"] = threading.Thread(target=self.run_job, args=(job,), name=f"job-{job['name']}", daemon=True)
+                    job["worker"].start()
+
+    def run_forever(self):
+        while True:
+            self.run_pending()
+            time.sleep(1)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run_forever, name="job-scheduler", daemon=True)
+                self._thread.start()
+
+    def metrics(self):
+        return [
+            {key: value for key, value in job.items() if key not in ("fn", "next_run", "worker")}
+            for job in self.jobs
+        ]
+
+
+scheduler = JobScheduler()
+
+
+@scheduler.job("expire_overdue_orders", interval=15)
+def expire_overdue_orders():
+    # Uses the (status, payment_deadline) index
+    db = get_db()
+    db.execute("begin immediate")
+    try:
+        rows = db.execute(
+            "select id from orders where status = ? and payment_deadline < ?",
+            (ORDER_STATUS_PENDING, datetime.utcnow().isoformat()),
+        ).fetchall()
+        order_ids = [row["id"] for row in rows]
+        cancel_orders(db, order_ids)
+        # Kept a while past expiry so reconcile_payments can still check them
+        db.execute(
+            "delete from snap_tokens where expires_at < ?",
+            ((datetime.utcnow() - app.config["PAYMENT_RECONCILE_LOOKBACK"]).isoformat(),),
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(order_ids)
+
+
+@scheduler.job("close_expired_batches", interval=30)
+def close_expired_batches():
+    # Batch deadlines are stored in server local time
+    db = get_db()
+    cursor = db.execute(
+        "update batches set status = 'Tutup' where is_active = 1 and status = 'Buka' and deadline < ?",
+        (datetime.now().isoformat(),),
+    )
+    db.commit()
+    if cursor.rowcount:
+        refresh_batch_version()
+    return cursor.rowcount
+
+
+@scheduler.job("reconcile_payments", interval=300, own_thread=True)
+def reconcile_payments():
+    # Catches payments whose notification never arrived: every pending order
+    # with a Snap transaction, plus ones cancelled within the lookback window.
+    # A pass stops starting lookups after PAYMENT_RECONCILE_BUDGET; the least
+    # recently checked transactions go first, so the next pass continues.
+    if payment_client.mock_mode:
+        return 0
+    db = get_db()
+    rows = db.execute(
+        """
+        select t.order_id, t.transaction_id from snap_tokens t
+        join orders o on o.id = t.order_id
+        where o.status = ? or (o.status = ? and t.expires_at > ?)
+        order by t.reconciled_at is not null, t.reconciled_at
+        """,
+        (
+            ORDER_STATUS_PENDING,
+            ORDER_STATUS_CANCELLED,
+            (datetime.utcnow() - app.config["PAYMENT_RECONCILE_LOOKBACK"]).isoformat(),
+        ),
+    ).fetchall()
+    if not rows:
+        return 0
+    close_db(None)  # don't hold a pooled connection during the gateway calls
+
+    transactions = payment_client.transaction_statuses(
+        [row["transaction_id"] for row in rows], deadline=time.monotonic() + app.config["PAYMENT_RECONCILE_BUDGET"]
+    )
+    db = get_db()
+    db.execute("begin immediate")
+    try:
+        changed = sum(
+            apply_payment_status(db, row["order_id"], transactions[row["transaction_id"]])
+            for row in rows
+            if transactions.get(row["transaction_id"])
+        )
+        now = datetime.utcnow().isoformat()
+        db.executemany(
+            "update snap_tokens set reconciled_at = ? where transaction_id = ?",
+            [(now, transaction_id) for transaction_id in transactions],
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return changed
+
+
+@scheduler.job("expire_sessions", interval=3600)
+def expire_sessions():
+    store = get_session_store()
+    if store is None:
+        return 0
+    now = datetime.utcnow()
+    return store.expire(now.isoformat(), (now - app.config["CART_ABANDON_AFTER"]).isoformat())
+
+
+@app.before_request
+def start_background_jobs():
+    if app.config["SCHEDULER_ENABLED"] and not app.testing:
+        scheduler.start()
+
+
+@app.route("/admin/jobs")
+def admin_jobs():
+    return jsonify({"jobs": scheduler.metrics()})
+
+
+@app.cli.command("run-jobs")
+def run_jobs_command():
+    """Run the background jobs in the foreground (sidecar mode)."""
+    scheduler.run_forever()
+
+
 if __name__ == "__main__":
     with app.app_context():
         init_db()
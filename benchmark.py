@@ -0,0 +1,750 @@
+"""Load benchmarks for SUKAIKAN.
+
+Runs the Flask app in a multi-threaded WSGI server against a throwaway copy
+of sukaikan.db and hammers it with concurrent clients.
+
+    python benchmark.py db          # /katalog and /checkout, DB tuning off vs on
+    python benchmark.py search      # LIKE vs FTS5 product search over 10k+ products
+    python benchmark.py payment     # /checkout and /bayar against a slow stub gateway
+    python benchmark.py capacity    # hundreds of simultaneous checkouts against one batch quota
+    python benchmark.py ai          # /api/ai-chat with a fake model backend, cache hit rate and savings
+    python benchmark.py ai-stream   # time to first byte, /api/ai-chat vs /api/ai-chat/stream
+    python benchmark.py ratelimit   # /checkout p99 during an AI chat spike, limits off vs on
+    python benchmark.py session     # cart traffic and cookie size, cookie vs sqlite vs memory sessions
+    python benchmark.py status      # payment confirmation latency and request count, polling vs long-poll
+    python benchmark.py reconcile   # signed payment notifications, and status API reconciliation by pool size
+"""
+import hashlib
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+from app import (
+    ai_chat, app, get_db, init_db, order_status_notifier, payment_client, rate_limiter, reconcile_payments,
+    search_product_ids, update_order_status,
+)
+
+BENCH_THREADS = int(os.environ.get("BENCH_THREADS", "16"))
+BENCH_SECONDS = float(os.environ.get("BENCH_SECONDS", "5"))
+
+
+def use_temp_database():
+    tmpdir = tempfile.mkdtemp(prefix="sukaikan-bench-")
+    path = os.path.join(tmpdir, "sukaikan.db")
+    shutil.copy(os.path.join(app.root_path, "sukaikan.db"), path)
+    app.config["DATABASE"] = path
+    with app.app_context():
+        init_db()
+    return tmpdir
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # count redirects as responses, don't follow them
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    # Fixed number of worker threads, like gunicorn --threads
+    def __init__(self, *args, workers=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class Server:
+    def __init__(self, workers=None):
+        if workers:
+            self.server = PooledWSGIServer("127.0.0.1", 0, app, handler=QuietHandler, workers=workers)
+        else:
+            self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+def new_client():
+    cookies = urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+    client = urllib.request.build_opener(cookies, NoRedirect)
+    client.cookie_jar = cookies.cookiejar
+    return client
+
+
+def post_json(client, url, payload):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+    )
+    with client.open(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def fetch(client, url, data=None):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    try:
+        with client.open(url, data=body, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        if e.code in (301, 302, 303):
+            return e.code
+        raise
+
+
+def run_load(worker, threads=BENCH_THREADS, seconds=BENCH_SECONDS):
+    # worker(client) performs one iteration and returns the number of requests made
+    counts = [0] * threads
+    errors = [0] * threads
+    stop_at = time.perf_counter() + seconds
+
+    def loop(i):
+        client = new_client()
+        while time.perf_counter() < stop_at:
+            try:
+                counts[i] += worker(client)
+            except Exception:
+                errors[i] += 1
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return sum(counts) / elapsed, sum(errors)
+
+
+def bench_db():
+    use_temp_database()
+    with Server() as server:
+        def katalog(client):
+            fetch(client, server.base_url + "/katalog")
+            return 1
+
+        def checkout(client):
+            fetch(client, server.base_url + "/keranjang/tambah", {"product_id": "udang-vaname", "qty": "2"})
+            fetch(client, server.base_url + "/checkout", {
+                "nama": "Bench", "hp": "0800", "maps_link": "-", "patokan": "-", "metode_bayar": "QRIS",
+            })
+            return 2
+
+        print(f"{BENCH_THREADS} threads, {BENCH_SECONDS:.0f}s per run")
+        for tuned in (False, True):
+            app.config["DB_TUNING"] = tuned
+            label = "tuned" if tuned else "default"
+            for name, worker in (("/katalog", katalog), ("/checkout", checkout)):
+                rps, errors = run_load(worker)
+                print(f"  {label:8} {name:10} {rps:8.1f} req/s  errors={errors}")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+SYNTHETIC_FISH = ["Kembung", "Tongkol", "Tenggiri", "Kakap", "Bandeng", "Udang", "Cumi", "Kerang", "Bawal", "Layur"]
+SYNTHETIC_STYLE = ["Fillet", "Segar", "Utuh", "Potong", "Vaname", "Tube", "Hijau", "Merah", "Premium", "Beku"]
+SYNTHETIC_RECIPE = ["Balado", "Goreng Tepung", "Bakar Kecap", "Saus Padang", "Asam Manis", "Pepes", "Gulai"]
+
+
+def bench_search(count=int(os.environ.get("BENCH_PRODUCTS", "10000")), queries=500):
+    use_temp_database()
+    rng = random.Random(42)
+    with app.app_context():
+        db = get_db()
+        for i in range(count):
+            fish, style = rng.choice(SYNTHETIC_FISH), rng.choice(SYNTHETIC_STYLE)
+            product_id = f"bench-{i}"
+            db.execute(
+                "insert into products (id, nama, kategori, harga_per_kg, label_musim, ukuran, tekstur, is_active) values (?, ?, ?, ?, '', ?, ?, 1)",
+                (product_id, f"{fish} {style} {i}", "ikan-laut", 40000, "Sedang", f"Daging {style.lower()}"),
+            )
+            db.execute(
+                "insert into recommendations (product_id, nama, estimasi) values (?, ?, '20 menit')",
+                (product_id, f"{fish} {rng.choice(SYNTHETIC_RECIPE)}"),
+            )
+        db.commit()
+
+        terms = [rng.choice(SYNTHETIC_FISH + SYNTHETIC_STYLE).lower()[:rng.randint(3, 6)] for _ in range(queries)]
+        like_times, fts_times = [], []
+        for term in terms:
+            started = time.perf_counter()
+            db.execute("select * from products where is_active = 1 and nama like ?", (f"%{term}%",)).fetchall()
+            like_times.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            search_product_ids(term)
+            fts_times.append((time.perf_counter() - started) * 1000)
+
+    print(f"{count} synthetic products, {queries} queries")
+    for label, samples in (("LIKE", like_times), ("FTS5", fts_times)):
+        print(f"  {label:5} mean={sum(samples) / len(samples):7.2f}ms  p50={percentile(samples, 50):7.2f}ms  p95={percentile(samples, 95):7.2f}ms")
+
+    # The storefront path: /katalog sends kategori="" when no category is picked
+    client = app.test_client()
+    for url in ("/katalog?q=udang", "/katalog?q=vana", "/katalog?q=udang&kategori=ikan-laut"):
+        hits = client.get(url).get_data(as_text=True).count("/produk/bench-")
+        print(f"  {url:36} {hits:4d} product links")
+        assert hits, f"{url} found nothing"
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    # Answers Snap /transactions and the /v2/<id>/status API after a fixed
+    # delay, like a slow gateway. transactions maps a transaction id to its
+    # status response; unknown ids answer 404 like Midtrans does.
+    latency = 2.0
+    calls = 0
+    transactions = {}
+
+    def do_POST(self):
+        StubGatewayHandler.calls += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        self.send_json(201, {"token": "stub-token", "redirect_url": "http://stub/pay"})
+
+    def do_GET(self):
+        StubGatewayHandler.calls += 1
+        time.sleep(self.latency)
+        transaction_id = urllib.parse.unquote(self.path.split("/")[2])
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None:
+            self.send_json(404, {"status_code": "404", "status_message": "Transaction doesn't exist."})
+        else:
+            self.send_json(200, transaction)
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_payment():
+    use_temp_database()
+    gateway = ThreadingHTTPServer(("127.0.0.1", 0), StubGatewayHandler)
+    threading.Thread(target=gateway.serve_forever, daemon=True).start()
+    payment_client.configure(
+        server_key="SB-Mid-server-bench",
+        snap_base_url=f"http://127.0.0.1:{gateway.server_port}/snap/v1",
+    )
+    with Server() as server:
+        latencies = []
+
+        def checkout(client):
+            fetch(client, server.base_url + "/keranjang/tambah", {"product_id": "udang-vaname", "qty": "1"})
+            started = time.perf_counter()
+            fetch(client, server.base_url + "/checkout", {
+                "nama": "Bench", "hp": "0800", "maps_link": "-", "patokan": "-", "metode_bayar": "QRIS",
+            })
+            latencies.append((time.perf_counter() - started) * 1000)
+            return 1
+
+        print(f"{BENCH_THREADS} threads, {BENCH_SECONDS:.0f}s per run, gateway latency {StubGatewayHandler.latency:.1f}s")
+
+        # Repeated "bayar ulang" clicks on a handful of pending orders
+        with app.app_context():
+            db = get_db()
+            deadline = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+            order_ids = [
+                db.execute(
+                    "insert into orders (nama, hp, alamat, kecamatan, metode_bayar, total, status, tanggal_pengiriman, items_json, created_at, payment_deadline) values ('Bench', '0800', '-', '-', 'QRIS', 50000, 'Menunggu Pembayaran', '-', '[]', ?, ?)",
+                    (datetime.utcnow().isoformat(), deadline),
+                ).lastrowid
+                for _ in range(8)
+            ]
+            db.commit()
+        clicks = []
+
+        def bayar_ulang(client):
+            started = time.perf_counter()
+            fetch(client, f"{server.base_url}/bayar/{random.choice(order_ids)}")
+            clicks.append((time.perf_counter() - started) * 1000)
+            return 1
+
+        StubGatewayHandler.calls = 0
+        rps, errors = run_load(bayar_ulang)
+        print(f"  reuse  /bayar    {rps:8.1f} req/s  p50={percentile(clicks, 50):8.1f}ms  p95={percentile(clicks, 95):8.1f}ms  errors={errors}  gateway calls={StubGatewayHandler.calls} for {len(clicks)} clicks")
+
+        for async_mode in (False, True):
+            app.config["PAYMENT_ASYNC"] = async_mode
+            latencies.clear()
+            rps, errors = run_load(checkout)
+            label = "async" if async_mode else "sync"
+            print(f"  {label:6} /checkout {rps:8.1f} req/s  p50={percentile(latencies, 50):8.1f}ms  p95={percentile(latencies, 95):8.1f}ms  errors={errors}")
+    gateway.shutdown()
+
+
+def bench_capacity(clients=int(os.environ.get("BENCH_CLIENTS", "300")), capacity=100):
+    use_temp_database()
+    with app.app_context():
+        db = get_db()
+        db.execute("update batches set status = 'Buka', deadline = ? where is_active = 1", ((datetime.now() + timedelta(days=1)).isoformat(),))
+        batch_id = db.execute("select id from batches where is_active = 1 order by id desc limit 1").fetchone()["id"]
+        db.execute("insert into batch_capacity (batch_id, product_id, capacity_kg) values (?, 'udang-vaname', ?)", (batch_id, capacity))
+        db.commit()
+
+    with Server() as server:
+        def run_round(keys):
+            # Every client fills its cart first, then all submit at once
+            barrier = threading.Barrier(len(keys))
+            results = {"errors": 0}
+            timings = []
+
+            def client_run(key):
+                client = new_client()
+                try:
+                    fetch(client, server.base_url + "/keranjang/tambah", {"product_id": "udang-vaname", "qty": "1"})
+                    barrier.wait()
+                    started = time.perf_counter()
+                    fetch(client, server.base_url + "/checkout", {
+                        "nama": "Bench", "hp": "0800", "maps_link": "-", "patokan": "-",
+                        "metode_bayar": "QRIS", "idempotency_key": key,
+                    })
+                    timings.append(time.perf_counter() - started)
+                except Exception:
+                    results["errors"] += 1
+
+            threads = [threading.Thread(target=client_run, args=(key,)) for key in keys]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            return timings, results["errors"]
+
+        timings, errors = run_round([f"bench-{i}" for i in range(clients)])
+        with app.app_context():
+            db = get_db()
+            orders, ordered_kg = db.execute(
+                "select count(distinct o.id), coalesce(sum(oi.qty), 0) from orders o join order_items oi on oi.order_id = o.id where o.batch_id = ? and o.status != 'Dibatalkan'",
+                (batch_id,),
+            ).fetchone()
+            reserved = db.execute("select reserved_kg from batch_capacity where batch_id = ?", (batch_id,)).fetchone()[0]
+        wall = max(timings)
+        print(f"{clients} simultaneous checkouts of 1kg against a {capacity}kg quota")
+        print(f"  orders={orders}  ordered={ordered_kg}kg  reserved={reserved}kg  oversold={max(0, ordered_kg - capacity)}kg  errors={errors}")
+        print(f"  {len(timings) / wall:8.1f} checkouts/s  p50={percentile(timings, 50) * 1000:8.1f}ms  p95={percentile(timings, 95) * 1000:8.1f}ms")
+        assert ordered_kg == reserved <= capacity, "quota oversold"
+
+        # The same form submitted by many clients at once makes one order
+        with app.app_context():
+            db = get_db()
+            db.execute("update batch_capacity set capacity_kg = capacity_kg + 1000 where batch_id = ?", (batch_id,))
+            db.commit()
+        timings, errors = run_round(["bench-dup"] * 50)
+        with app.app_context():
+            dupes = get_db().execute("select count(*) from orders where idempotency_key = 'bench-dup'").fetchone()[0]
+        print(f"  50 simultaneous submits of one idempotency key -> {dupes} order(s)  errors={errors}")
+        assert dupes == 1, "duplicate orders"
+
+
+class FakeAIBackend:
+    # Stands in for Gemini: fixed latency, canned answer, counts calls
+    def __init__(self, latency=0.8):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate(self, question, context=None):
+        return "".join(self.stream(question, context))
+
+    def stream(self, question, context=None):
+        # The answer arrives in 20 chunks spread over the latency
+        with self._lock:
+            self.calls += 1
+        words = f"Jawaban untuk: <strong>{question}</strong>\n{'ikan segar ' * 18}Selamat memasak!".split(" ")
+        step = max(len(words) // 20, 1)
+        for i in range(0, len(words), step):
+            time.sleep(self.latency / 20)
+            yield " ".join(words[i:i + step]) + " "
+
+
+AI_QUESTIONS = [
+    "gizi ikan kembung", "resep tongkol balado", "cara menyimpan udang", "ikan apa yang bagus untuk MPASI",
+    "bedanya kakap merah dan kakap putih", "cara fillet ikan tenggiri", "omega 3 ikan salmon", "cumi dimasak apa",
+    "berapa lama ikan tahan di freezer", "ciri ikan segar", "resep bandeng presto", "kerang hijau aman untuk anak",
+    "harga udang vaname", "ukuran kembung fillet", "berapa harga cumi sekilo", "kerang hijau enaknya dimasak apa",
+]
+
+
+def bench_ai():
+    use_temp_database()
+    backend = FakeAIBackend()
+    ai_chat.backend = backend
+    ai_chat.cache.clear()
+    ai_chat.reset_stats()
+    rng = random.Random(7)
+    lock = threading.Lock()
+    latencies = []
+
+    def variant(question):
+        # Same question typed differently
+        if rng.random() < 0.3:
+            question = question.capitalize() + "?"
+        if rng.random() < 0.2:
+            question = question.upper() + "!!"
+        return question
+
+    with Server() as server:
+        def ask(client):
+            with lock:
+                # Skewed towards the first questions, like real traffic
+                question = variant(AI_QUESTIONS[min(int(rng.expovariate(0.35)), len(AI_QUESTIONS) - 1)])
+            started = time.perf_counter()
+            post_json(client, server.base_url + "/api/ai-chat", {"question": question})
+            latencies.append((time.perf_counter() - started) * 1000)
+            return 1
+
+        rps, errors = run_load(ask)
+
+    stats = ai_chat.metrics()
+    print(f"{BENCH_THREADS} threads, {BENCH_SECONDS:.0f}s, fake model latency {backend.latency:.1f}s, {len(AI_QUESTIONS)} distinct questions")
+    print(f"  {rps:8.1f} req/s  p50={percentile(latencies, 50):8.1f}ms  p95={percentile(latencies, 95):8.1f}ms  errors={errors}")
+    print(f"  questions={stats['questions']}  upstream calls={backend.calls}  hit rate={stats['hit_rate']:.1%}  "
+          f"local={stats['local_answers']}  coalesced={stats['coalesced']}  saved={stats['upstream_calls_saved']}")
+    print(f"  uncached, every question waits on the model: at most {BENCH_THREADS / backend.latency:.1f} req/s")
+
+
+def bench_ai_stream(requests_per_endpoint=40, threads=8):
+    use_temp_database()
+    backend = FakeAIBackend()
+    ai_chat.backend = backend
+    app.config["AI_CHAT_CACHE_PERSIST"] = False
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    with Server() as server:
+        def measure(path):
+            ttfb, total = [], []
+
+            def worker():
+                client = new_client()
+                for _ in range(requests_per_endpoint // threads):
+                    with lock:
+                        question = f"pertanyaan baru {next(counter)}"  # always a cache miss
+                    request = urllib.request.Request(
+                        server.base_url + path,
+                        data=json.dumps({"question": question}).encode(),
+                        headers={"Content-Type": "application/json"},
+                    )
+                    started = time.perf_counter()
+                    with client.open(request, timeout=30) as response:
+                        response.read(1)
+                        ttfb.append((time.perf_counter() - started) * 1000)
+                        response.read()
+                    total.append((time.perf_counter() - started) * 1000)
+
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            return ttfb, total
+
+        print(f"{requests_per_endpoint} uncached questions per endpoint, {threads} threads, fake model latency {backend.latency:.1f}s in 20 chunks")
+        for path in ("/api/ai-chat", "/api/ai-chat/stream"):
+            ttfb, total = measure(path)
+            print(f"  {path:20} ttfb p50={percentile(ttfb, 50):7.1f}ms p95={percentile(ttfb, 95):7.1f}ms  total p50={percentile(total, 50):7.1f}ms")
+
+
+def bench_ratelimit(workers=8, shoppers=4, chatters=32):
+    use_temp_database()
+    backend = FakeAIBackend(latency=2.0)
+    ai_chat.backend = backend
+    app.config["AI_CHAT_CACHE_PERSIST"] = False
+    protected_limits = app.config["AI_CHAT_RATE_LIMITS"]
+    protected_slots = ai_chat.upstream_slots
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    with Server(workers=workers) as server:
+        def shop(latencies):
+            def worker(client):
+                for path, data in (
+                    ("/keranjang/tambah", {"product_id": "udang-vaname", "qty": "1"}),
+                    ("/checkout", {"nama": "Bench", "hp": "0800", "maps_link": "-", "patokan": "-", "metode_bayar": "QRIS"}),
+                ):
+                    started = time.perf_counter()
+                    fetch(client, server.base_url + path, data)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                return 2
+            return worker
+
+        def chat(client):
+            with lock:
+                question = f"pertanyaan baru {next(counter)}"
+            try:
+                post_json(client, server.base_url + "/api/ai-chat", {"question": question})
+            except urllib.error.HTTPError as e:
+                if e.code != 429:
+                    raise
+            return 1
+
+        print(f"{workers} worker threads, {shoppers} shoppers, {chatters} chat clients, fake model latency {backend.latency:.1f}s")
+        for label, spike, protected in (("no chat", False, True), ("unlimited", True, False), ("limited", True, True)):
+            if protected:
+                app.config["AI_CHAT_RATE_LIMITS"] = protected_limits
+                ai_chat.upstream_slots = protected_slots
+            else:
+                app.config["AI_CHAT_RATE_LIMITS"] = {scope: (10 ** 6, 10 ** 6) for scope in protected_limits}
+                ai_chat.upstream_slots = threading.BoundedSemaphore(10 ** 6)
+            rate_limiter.backend.reset()
+            ai_chat.reset_stats()
+            backend.calls = 0
+
+            latencies = []
+            spike_thread = None
+            if spike:
+                spike_thread = threading.Thread(target=run_load, args=(chat, chatters, BENCH_SECONDS + 2))
+                spike_thread.start()
+                time.sleep(1)
+            rps, errors = run_load(shop(latencies), threads=shoppers)
+            if spike_thread:
+                spike_thread.join()
+            stats = ai_chat.metrics()
+            print(f"  {label:10} shop {rps:7.1f} req/s  p50={percentile(latencies, 50):8.1f}ms  p99={percentile(latencies, 99):8.1f}ms  errors={errors}"
+                  f"  | chat upstream={backend.calls} 429s={stats['rate_limited'] + stats['busy']}")
+    ai_chat.upstream_slots = protected_slots
+    app.config["AI_CHAT_RATE_LIMITS"] = protected_limits
+
+
+def bench_session():
+    use_temp_database()
+    products = ["kembung-fillet", "tongkol-segar", "udang-vaname", "cumi-tube", "kerang-hijau"]
+    with Server() as server:
+        print(f"{BENCH_THREADS} threads, {BENCH_SECONDS:.0f}s per run")
+        for label, backend, tuned in (
+            ("cookie", "cookie", False), ("sqlite", "sqlite", False), ("sqlite+tuning", "sqlite", True), ("memory", "memory", False),
+        ):
+            app.config["SESSION_BACKEND"] = backend
+            app.config["DB_TUNING"] = tuned
+            cookie_sizes = []
+
+            def shop(client):
+                fetch(client, server.base_url + "/keranjang/tambah", {"product_id": random.choice(products), "qty": "1"})
+                fetch(client, server.base_url + "/keranjang")
+                cookie_sizes.append(sum(len(c.name) + len(c.value) + 1 for c in client.cookie_jar))
+                return 2
+
+            rps, errors = run_load(shop)
+            print(f"  {label:13} {rps:8.1f} req/s  cookie header p50={percentile(cookie_sizes, 50):5d}B  max={max(cookie_sizes):5d}B  errors={errors}")
+
+
+def bench_status(watchers=int(os.environ.get("BENCH_WATCHERS", "100")), poll_interval=2.0):
+    use_temp_database()
+    deadline = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    with app.app_context():
+        db = get_db()
+        order_ids = [
+            db.execute(
+                "insert into orders (nama, hp, total, status, payment_deadline, created_at) values ('Bench', ?, 10000, 'Menunggu Pembayaran', ?, ?)",
+                (f"0899{i:06d}", deadline, datetime.utcnow().isoformat()),
+            ).lastrowid
+            for i in range(watchers)
+        ]
+        db.commit()
+
+    with Server() as server:
+        print(f"{watchers} clients watching one unpaid order each, all paid within ~4s")
+        for label, wait in (("poll 2s", 0), ("long-poll", 25)):
+            paid_at = {}
+            seen_at = {}
+            counts = [0] * watchers
+            errors = [0]
+
+            def watch(i):
+                order_id = order_ids[i]
+                client = new_client()
+                try:
+                    fetch(client, server.base_url + "/lacak", {"hp": f"0899{i:06d}"})
+                    url = f"{server.base_url}/api/pesanan/{order_id}/status"
+                    version = json.loads(client.open(url, timeout=30).read())["version"]
+                    while True:
+                        query = urllib.parse.urlencode({"since": version, "wait": wait})
+                        with client.open(f"{url}?{query}", timeout=30) as response:
+                            data = json.loads(response.read())
+                        counts[i] += 1
+                        if data["version"] != version:
+                            seen_at[order_id] = time.perf_counter()
+                            return
+                        if not wait:
+                            time.sleep(poll_interval)
+                except Exception:
+                    errors[0] += 1
+
+            threads = [threading.Thread(target=watch, args=(i,)) for i in range(watchers)]
+            for t in threads:
+                t.start()
+            time.sleep(1)  # let every client look up its order first
+            # Payments land at random moments over the next few seconds
+            for order_id in random.sample(order_ids, len(order_ids)):
+                time.sleep(random.uniform(0, 4 / watchers))
+                with app.app_context():
+                    db = get_db()
+                    update_order_status(db, order_id, "Lunas")
+                    db.commit()
+                paid_at[order_id] = time.perf_counter()
+            for t in threads:
+                t.join()
+            latencies = [seen_at[o] - paid_at[o] for o in seen_at]
+            print(
+                f"  {label:9} {sum(counts):6d} status requests  confirmation p50={percentile(latencies, 50) * 1000:7.1f}ms"
+                f"  p95={percentile(latencies, 95) * 1000:7.1f}ms  waiting now={order_status_notifier.waiting()}  errors={errors[0]}"
+            )
+            with app.app_context():
+                db = get_db()
+                db.execute("update orders set status = 'Menunggu Pembayaran' where id in (%s)" % ", ".join("?" * len(order_ids)), order_ids)
+                db.commit()
+
+
+def signed_transaction(order_id, total, transaction_status, server_key):
+    # A Midtrans notification / status body with a valid signature_key
+    payload = {
+        "order_id": order_id,
+        "status_code": "200" if transaction_status in ("settlement", "capture") else "202",
+        "gross_amount": f"{total}.00",
+        "transaction_status": transaction_status,
+        "fraud_status": "accept",
+    }
+    raw = payload["order_id"] + payload["status_code"] + payload["gross_amount"] + server_key
+    payload["signature_key"] = hashlib.sha512(raw.encode()).hexdigest()
+    return payload
+
+
+def bench_reconcile(orders=int(os.environ.get("BENCH_ORDERS", "200")), latency=0.1):
+    use_temp_database()
+    server_key = "SB-Mid-server-bench"
+    StubGatewayHandler.latency = latency
+    gateway = ThreadingHTTPServer(("127.0.0.1", 0), StubGatewayHandler)
+    threading.Thread(target=gateway.serve_forever, daemon=True).start()
+    payment_client.configure(server_key=server_key, core_base_url=f"http://127.0.0.1:{gateway.server_port}")
+
+    def create_orders():
+        # Pending orders with a Snap transaction each, about half of them paid at the gateway
+        deadline = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+        StubGatewayHandler.transactions = {}
+        with app.app_context():
+            db = get_db()
+            db.execute("delete from snap_tokens")
+            created = []
+            for i in range(orders):
+                order_id = db.execute(
+                    "insert into orders (nama, hp, total, status, payment_deadline, created_at) values ('Bench', '0800', 50000, 'Menunggu Pembayaran', ?, ?)",
+                    (deadline, datetime.utcnow().isoformat()),
+                ).lastrowid
+                transaction_id = f"ORDER-{order_id}-{i}"
+                db.execute(
+                    "insert into snap_tokens (order_id, token, transaction_id, expires_at, created_at) values (?, 'stub-token', ?, ?, ?)",
+                    (order_id, transaction_id, deadline, datetime.utcnow().isoformat()),
+                )
+                if i % 2:
+                    StubGatewayHandler.transactions[transaction_id] = signed_transaction(transaction_id, 50000, "settlement", server_key)
+                created.append(transaction_id)
+            db.commit()
+        return created
+
+    def paid_orders():
+        with app.app_context():
+            return get_db().execute("select count(*) from orders where status = 'Sudah Dibayar'").fetchone()[0]
+
+    print(f"{orders} pending orders, half paid at the gateway, status API latency {latency * 1000:.0f}ms")
+    for workers in (1, 4, 16):
+        app.config["PAYMENT_RECONCILE_WORKERS"] = workers
+        create_orders()
+        before = paid_orders()
+        StubGatewayHandler.calls = 0
+        started = time.perf_counter()
+        with app.app_context():
+            reconcile_payments()
+        elapsed = time.perf_counter() - started
+        print(f"  reconcile workers={workers:2d}  {elapsed * 1000:8.1f}ms  status calls={StubGatewayHandler.calls}  paid={paid_orders() - before}")
+
+    # Every notification delivered twice, concurrently, plus one forged
+    transaction_ids = create_orders()
+    before = paid_orders()
+    with Server() as server:
+        notifications = [StubGatewayHandler.transactions.get(t) or signed_transaction(t, 50000, "expire", server_key) for t in transaction_ids] * 2
+        random.shuffle(notifications)
+        timings = []
+
+        def deliver(payload):
+            started = time.perf_counter()
+            post_json(new_client(), server.base_url + "/api/midtrans/notification", payload)
+            timings.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(BENCH_THREADS) as pool:
+            list(pool.map(deliver, notifications))
+        elapsed = time.perf_counter() - started
+        forged = dict(notifications[0], gross_amount="1.00")
+        try:
+            post_json(new_client(), server.base_url + "/api/midtrans/notification", forged)
+            forged_status = 200
+        except urllib.error.HTTPError as e:
+            forged_status = e.code
+    print(
+        f"  notifications  {len(notifications) / elapsed:8.1f} req/s  p50={percentile(timings, 50) * 1000:6.1f}ms"
+        f"  p95={percentile(timings, 95) * 1000:6.1f}ms  paid={paid_orders() - before} of {orders // 2}  forged -> {forged_status}"
+    )
+    assert paid_orders() - before == orders // 2, "notifications not applied exactly once"
+    gateway.shutdown()
+
+
+BENCHMARKS = {
+    "db": bench_db,
+    "search": bench_search,
+    "payment": bench_payment,
+    "capacity": bench_capacity,
+    "ai": bench_ai,
+    "ai-stream": bench_ai_stream,
+    "ratelimit": bench_ratelimit,
+    "session": bench_session,
+    "status": bench_status,
+    "reconcile": bench_reconcile,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()